@@ -9,12 +9,29 @@
 #
 ## Imports
 #
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
 from datetime import datetime
 from pathlib import Path
 import subprocess
+import argparse
+import hashlib
+import fcntl
+import heapq
+import tarfile
+import fnmatch
+import time
+import lzma
 import logging
 import socket
 import requests
+import gzip
+import json
+import shutil
+import stat
+import zlib
+import sys
+import re
 import os
 
 #
@@ -26,7 +43,38 @@ LOG_FILE_PREFIX = "backup"
 SLACK_WEBHOOK = "https://hooks.slack.com/services/your/webhook/url"
 MAX_BACKUPS = 7
 INCLUDE_PATHS = ["/dir1", "/dir2"] # Directories to include [absolute paths]
-EXCLUDE_PATHS = ["/dir1/exclude", "/dir2/exclude"]  # Directories to exclude [absolute paths]
+EXCLUDE_PATHS = ["/dir1/exclude", "/dir2/exclude"]  # Directories to exclude [absolute paths or glob patterns, e.g. "*.tmp"]
+COMPRESSION = "gzip"  # "gzip", "zstd", "xz", "lz4" or "none" (zstd/lz4 require the zstandard/lz4 python packages)
+COMPRESSION_LEVEL = None  # None uses the codec default (gzip: 6, zstd: 3, xz: 6, lz4: 0)
+COMPRESSION_THREADS = 0  # zstd worker threads, 0 uses all CPU cores
+PROGRESS_INTERVAL = 10000  # Log archiving progress every N files
+BACKUP_MODE = "archive"  # "archive" (one tar archive per run), "incremental" (changed files only), "sharded" (parallel archive set) or "dedup" (chunk store + manifests)
+FULL_BACKUP_INTERVAL = 7  # "incremental" mode creates a full archive every N runs, keeping restore chains bounded
+SHARD_COUNT = os.cpu_count() or 4  # Number of size-balanced archives a "sharded" backup is split into (compressed in parallel)
+SEEKABLE_INDEX = True  # Compress archives in independent blocks and write a sidecar index, single files are restored without decompressing the whole archive
+INDEX_BLOCK_SIZE = 1024 * 1024  # Uncompressed size after which a new compressed block is started (smaller blocks seek faster but compress worse)
+CHUNK_DIR = BACKUP_DIR / "chunks"  # Chunk store used by the "dedup" mode (can be shared by multiple hosts)
+CHUNK_MIN_SIZE = 256 * 1024  # Smallest chunk cut from a file in "dedup" mode (smaller files are stored as one chunk)
+CHUNK_MAX_SIZE = 4 * 1024 * 1024  # Largest chunk cut from a file in "dedup" mode
+CHUNK_GC_GRACE = 24 * 60 * 60  # Unreferenced chunks younger than this many seconds are kept by the "dedup" garbage collection
+
+BACKUP_MODES = ("archive", "incremental", "sharded", "dedup")
+CODEC_EXTENSIONS = {"gzip": ".tgz", "zstd": ".tar.zst", "xz": ".tar.xz", "lz4": ".tar.lz4", "none": ".tar"}
+CODEC_DEFAULT_LEVELS = {"gzip": 6, "zstd": 3, "xz": 6, "lz4": 0}
+TAR_CODEC_OPTIONS = {"gzip": ["-z"], "zstd": ["--zstd"], "xz": ["-J"], "lz4": ["-I", "lz4"], "none": []}
+
+# Chunk boundaries are placed after a newline whose preceding CHUNK_WINDOW bytes hash to zero under CHUNK_MASK.
+# Candidates are found by the regex engine, so boundaries depend only on local content without a per-byte python loop.
+CHUNK_TRIGGER = re.compile(rb"\n")
+CHUNK_WINDOW = 48
+CHUNK_MASK = (1 << 12) - 1
+MANIFEST_SUFFIX = ".manifest.json.gz"
+TAR_BUFFER_SIZE = 1024 * 1024
+INCREMENTAL_SUFFIX = ".inc"
+SHARD_SUFFIX = ".shards"
+SHARD_INDEX = "index.json.gz"
+DELETED_SUFFIX = ".deleted.json.gz"
+INDEX_SUFFIX = ".idx.json.gz"
 
 #
 ## Core Logging Setup
@@ -58,47 +106,875 @@ def notify_slack(message):
     except Exception as e:
         logging.error(f"Slack notification failed: {e}")
 
-def shell_exec(command, description):
-    logging.info(f"Running: {description}")
-    try:
-        result = subprocess.run(command, shell=True, check=True, capture_output=True)
-        logging.info(result.stdout.decode())
-        return True
-    except subprocess.CalledProcessError as e:
-        logging.error(f"{description} failed:\n{e.stderr.decode()}")
-        notify_slack(f"System backup error: {description} failed on {socket.gethostname()}")
-        return False
-
-def rotate_backups(backup_dir, hostname):
+def open_compressed(path, mode='wb'):
+    level = COMPRESSION_LEVEL if COMPRESSION_LEVEL is not None else CODEC_DEFAULT_LEVELS.get(COMPRESSION)
+
+    if COMPRESSION == "gzip":
+        return gzip.open(path, mode, compresslevel=level)
+    elif COMPRESSION == "xz":
+        return lzma.open(path, mode, preset=level)
+    elif COMPRESSION == "zstd":
+        import zstandard
+        return zstandard.open(path, mode, cctx=zstandard.ZstdCompressor(level=level, threads=COMPRESSION_THREADS or -1))
+    elif COMPRESSION == "lz4":
+        import lz4.frame
+        return lz4.frame.open(path, mode, compression_level=level)
+    else:
+        return open(path, mode)
+
+class PaddedReader:
+    # Files that shrink while being archived are padded with zeros (like GNU tar), a short member would corrupt the stream
+    def __init__(self, file, size, digest=None):
+        self.file = file
+        self.remaining = size
+        self.digest = digest
+
+    def read(self, size=-1):
+        size = self.remaining if size < 0 else min(size, self.remaining)
+        data = self.file.read(size)
+        data += b"\0" * (size - len(data))
+        self.remaining -= len(data)
+        if self.digest is not None:
+            self.digest.update(data)
+        return data
+
+def compile_excludes(patterns):
+    # Plain paths are matched with a set lookup (excluded directories are never descended into), globs with one regex
+    globs = [fnmatch.translate(pattern) for pattern in patterns if any(char in pattern for char in "*?[")]
+    paths = {pattern.rstrip('/') for pattern in patterns if not any(char in pattern for char in "*?[")}
+    return paths, re.compile("|".join(globs)) if globs else None
+
+EXCLUDED_PATHS, EXCLUDED_GLOBS = compile_excludes(EXCLUDE_PATHS)
+
+def is_excluded(path):
+    return path in EXCLUDED_PATHS or (EXCLUDED_GLOBS is not None and EXCLUDED_GLOBS.match(path) is not None)
+
+def walk_paths():
+    for root in INCLUDE_PATHS:
+        if is_excluded(root) or any(root.startswith(f"{excluded}/") for excluded in EXCLUDED_PATHS):
+            continue
+
+        try:
+            root_st = os.lstat(root)
+        except OSError as e:
+            logging.error(f"Unable to read {root}: {e}")
+            continue
+
+        # A root that is a file (or symlink) is yielded like any entry, only directories are descended into
+        yield root, root_st
+        if not stat.S_ISDIR(root_st.st_mode):
+            continue
+
+        stack = [root]
+        while stack:
+            directory = stack.pop()
+            try:
+                entries = os.scandir(directory)
+            except OSError as e:
+                logging.error(f"Unable to read {directory}: {e}")
+                continue
+
+            with entries:
+                for entry in entries:
+                    # An entry that vanishes or cannot be read mid-walk is skipped on its own, its siblings are still walked
+                    try:
+                        if is_excluded(entry.path):
+                            continue
+                        st = entry.stat(follow_symlinks=False)
+                    except OSError as e:
+                        logging.error(f"Unable to read {entry.path}: {e}")
+                        continue
+
+                    yield entry.path, st
+                    if stat.S_ISDIR(st.st_mode):
+                        stack.append(entry.path)
+
+def rotate_backups(backup_dir, hostname, suffixes):
+    # Archives of every codec are rotated, backups made before COMPRESSION was changed would otherwise never be deleted
+    suffixes = (suffixes,) if isinstance(suffixes, str) else tuple(suffixes)
     backups = sorted(
-        backup_dir.glob(f"{hostname}-*.tgz"),
+        (path for path in backup_dir.glob(f"{hostname}-*") if path.name.endswith(suffixes)),
         key=os.path.getmtime,
         reverse=True
     )
 
-    for old_backup in backups[MAX_BACKUPS:]:
+    # An incremental archive is useless without the archives it is based on, keep its chain back to the last full one
+    incremental = tuple(f"{INCREMENTAL_SUFFIX}{suffix}" for suffix in suffixes)
+    keep = MAX_BACKUPS
+    while keep < len(backups) and backups[keep - 1].name.endswith(incremental):
+        keep += 1
+
+    for old_backup in backups[keep:]:
         try:
-            old_backup.unlink()
+            if old_backup.is_dir():
+                shutil.rmtree(old_backup)
+            else:
+                old_backup.unlink()
+            Path(f"{old_backup}{DELETED_SUFFIX}").unlink(missing_ok=True)
+            Path(f"{old_backup}{INDEX_SUFFIX}").unlink(missing_ok=True)
             logging.info(f"Deleted old backup: {old_backup}")
         except Exception as e:
             logging.error(f"Failed to delete old backup {old_backup}: {e}")
 
+#
+## Seekable Index Functions
+#
+def open_frame(fileobj, mode='wb', codec=None):
+    # Compressed frame on an already open file, closing it ends the frame but keeps the file open
+    codec = codec or COMPRESSION
+    level = COMPRESSION_LEVEL if COMPRESSION_LEVEL is not None else CODEC_DEFAULT_LEVELS.get(codec)
+
+    if codec == "gzip":
+        return gzip.GzipFile(fileobj=fileobj, mode=mode, compresslevel=level)
+    elif codec == "xz":
+        return lzma.LZMAFile(fileobj, mode, preset=level if 'w' in mode else None)
+    elif codec == "zstd":
+        import zstandard
+        if 'w' in mode:
+            return zstandard.ZstdCompressor(level=level, threads=COMPRESSION_THREADS or -1).stream_writer(fileobj, closefd=False)
+        return zstandard.ZstdDecompressor().stream_reader(fileobj, read_across_frames=True, closefd=False)
+    elif codec == "lz4":
+        import lz4.frame
+        return lz4.frame.LZ4FrameFile(fileobj, mode, compression_level=level)
+    raise ValueError(f"Unknown codec: {codec}")
+
+class BlockWriter:
+    # Tar stream split into independently compressed blocks (concatenated gzip members / zstd, xz or lz4 frames).
+    # The result is still a regular archive, but decompression can start at any block boundary.
+    def __init__(self, file):
+        self.file = file
+        self.position = 0
+        self.block_start = 0
+        self.block_offset = 0
+        self.block = open_frame(file) if COMPRESSION != "none" else file
+
+    def write(self, data):
+        self.block.write(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def next_block(self):
+        if self.position - self.block_start < INDEX_BLOCK_SIZE:
+            return
+        if self.block is not self.file:
+            self.block.close()
+        self.block_offset = self.file.tell()
+        self.block_start = self.position
+        if self.block is not self.file:
+            self.block = open_frame(self.file)
+
+    def close(self):
+        if self.block is not self.file:
+            self.block.close()
+
+def read_archive_index(archive):
+    # Returns the codec the archive was written with and its entries, None when there is no usable index
+    index_file = Path(f"{archive}{INDEX_SUFFIX}")
+    if not index_file.exists():
+        return None
+
+    with gzip.open(index_file, 'rt') as f_in:
+        codec = json.loads(f_in.readline()).get("codec")
+        if codec not in CODEC_EXTENSIONS:
+            logging.warning(f"{index_file} records an unknown codec ({codec}), falling back to tar")
+            return None
+        return codec, {entry[0]: entry for entry in map(json.loads, f_in)}
+
+def extract_indexed(archive, codec, entry, target_dir):
+    # Only the block holding the file is decompressed: seek to it, skip the members before the file and copy the file itself
+    path, block_offset, data_offset, size, mtime, mode, sha256 = entry
+    destination = Path(target_dir) / path.lstrip('/')
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    digest = hashlib.sha256()
+
+    with open(archive, 'rb') as f_raw:
+        f_raw.seek(block_offset)
+        f_in = open_frame(f_raw, 'rb', codec) if codec != "none" else f_raw
+        while data_offset > 0:
+            skipped = len(f_in.read(min(data_offset, TAR_BUFFER_SIZE)))
+            if not skipped:
+                raise EOFError(f"{archive} is truncated")
+            data_offset -= skipped
+
+        with open(destination, 'wb') as f_out:
+            while size > 0:
+                data = f_in.read(min(size, TAR_BUFFER_SIZE))
+                if not data:
+                    raise EOFError(f"{archive} is truncated")
+                digest.update(data)
+                f_out.write(data)
+                size -= len(data)
+
+    if digest.hexdigest() != sha256:
+        raise ValueError(f"Checksum mismatch for {path} in {archive}")
+    os.chmod(destination, mode)
+    os.utime(destination, (mtime, mtime))
+    return destination
+
+def restore_indexed(archives, target_dir, path):
+    # Newest archive first: the first index holding the file has its latest version, a deletion list holding it ends the search.
+    # Returns None when an archive has no index (or the path is a directory), the caller falls back to extracting with tar.
+    for archive in reversed(archives):
+        archive_index = read_archive_index(archive)
+        if archive_index is None:
+            return None
+        codec, index = archive_index
+        if path in index:
+            print(f"Extracting {path} from {archive.name}")
+            extract_indexed(archive, codec, index[path], target_dir)
+            return 0
+
+        deleted_file = Path(f"{archive}{DELETED_SUFFIX}")
+        if deleted_file.exists():
+            with gzip.open(deleted_file, 'rt') as f_in:
+                if path in json.load(f_in):
+                    print(f"{path} was deleted in {archive.name}")
+                    return 1
+    return None
+
+#
+## Incremental Functions
+#
+def index_path(hostname):
+    return BACKUP_DIR / f"{hostname}.index.json.gz"
+
+def read_index(hostname):
+    path = index_path(hostname)
+    if not path.exists():
+        return {}, {}
+
+    with gzip.open(path, 'rt') as f_in:
+        header = json.loads(f_in.readline())
+        return header, {entry[0]: entry for entry in map(json.loads, f_in)}
+
+def write_index(hostname, header, entries):
+    path = index_path(hostname)
+    temp_path = path.with_name(f".{path.name}.tmp")
+
+    with gzip.open(temp_path, 'wt') as f_out:
+        f_out.write(json.dumps(header) + "\n")
+        for entry in entries.values():
+            f_out.write(json.dumps(entry) + "\n")
+    os.replace(temp_path, path)
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f_in:
+        while data := f_in.read(1024 * 1024):
+            digest.update(data)
+    return digest.hexdigest()
+
+def scan_changes(index):
+    # Index entries: [path, size, mtime_ns, inode, sha256 (files) / link target (symlinks) / None (directories)]
+    entries = {}
+    changed = []
+
+    for path, st in walk_paths():
+        old = index.get(path)
+
+        if stat.S_ISDIR(st.st_mode):
+            entries[path] = [path, 0, st.st_mtime_ns, st.st_ino, None]
+            if old is None:
+                changed.append(path)
+        elif stat.S_ISLNK(st.st_mode):
+            try:
+                target = os.readlink(path)
+            except OSError as e:
+                logging.error(f"Unable to read {path}: {e}")
+                if old:
+                    entries[path] = old
+                continue
+
+            entries[path] = [path, 0, st.st_mtime_ns, st.st_ino, target]
+            if old != entries[path]:
+                changed.append(path)
+        elif stat.S_ISREG(st.st_mode):
+            if old and old[1:4] == [st.st_size, st.st_mtime_ns, st.st_ino]:
+                entries[path] = old
+                continue
+
+            # Metadata changed, the content hash tells a real modification from a touched file
+            try:
+                digest = file_hash(path)
+            except OSError as e:
+                # The file still exists, keeping its previous entry stops the restore from deleting it
+                logging.error(f"Unable to read {path}: {e}")
+                if old:
+                    entries[path] = old
+                continue
+
+            entries[path] = [path, st.st_size, st.st_mtime_ns, st.st_ino, digest]
+            if old is None or old[4] != digest:
+                changed.append(path)
+
+    deleted = [path for path in index if path not in entries]
+    return entries, changed, deleted
+
+def incremental_backup(hostname, date_str):
+    # Several runs a day each add a chain member, the time keeps their names apart
+    date_str = f"{date_str}-{datetime.now().strftime('%H%M%S')}"
+    header, index = read_index(hostname)
+    last_full = BACKUP_DIR / header.get("last_full", "")
+    # A changed COMPRESSION starts a new chain, restores only follow archives written with the same codec
+    full = (not index or not last_full.is_file() or not last_full.name.endswith(CODEC_EXTENSIONS[COMPRESSION])
+            or header.get("incrementals", 0) + 1 >= FULL_BACKUP_INTERVAL)
+
+    logging.info(f"Scanning {', '.join(INCLUDE_PATHS)} for changes against {index_path(hostname)}")
+    entries, changed, deleted = scan_changes(index)
+    logging.info(f"Found {len(changed)} new/modified and {len(deleted)} deleted paths ({len(entries)} indexed)")
+
+    if full:
+        # The index holds every walked path in walk order, so the tree is not walked a second time
+        backup_file = archive_backup(hostname, date_str, list(entries), overwrite=False)
+        header = {"last_full": backup_file.name if backup_file else "", "incrementals": 0}
+    else:
+        # Only changed paths are archived, directories are stored without their (unchanged) content
+        backup_file = archive_backup(hostname, date_str, changed, INCREMENTAL_SUFFIX, overwrite=False)
+        if backup_file is None:
+            return None
+
+        with gzip.open(f"{backup_file}{DELETED_SUFFIX}", 'xt') as f_out:
+            json.dump(deleted, f_out)
+        header = {"last_full": header["last_full"], "incrementals": header.get("incrementals", 0) + 1}
+
+    # The index only moves forward once the archive exists, a failed run is retried against the old state
+    if backup_file:
+        write_index(hostname, header, entries)
+    return backup_file
+
+def archive_codec(archive):
+    # The longest matching extension wins, ".tar" is also the end of no other extension but is checked last
+    extensions = sorted(CODEC_EXTENSIONS.items(), key=lambda item: len(item[1]), reverse=True)
+    return next((codec for codec, extension in extensions if str(archive).endswith(extension)), None)
+
+def extract_tar(archive, target_dir, prefix=""):
+    # GNU tar does not detect lz4 on its own, so the decompressor is always passed explicitly.
+    # Returns 0 when extracted, 2 when the prefix is not part of the archive and 1 on any other error.
+    codec = archive_codec(archive)
+    if codec is None:
+        print(f"Unknown archive format: {archive}")
+        return 1
+
+    member = [prefix.lstrip('/')] if prefix else []
+    result = subprocess.run(["tar", *TAR_CODEC_OPTIONS[codec], "-xpf", str(archive), "-C", str(target_dir), *member], capture_output=True)
+    if result.returncode == 0:
+        return 0
+
+    stderr = result.stderr.decode(errors="replace")
+    errors = [line for line in stderr.splitlines() if line and "Exiting with failure status" not in line]
+    if member and errors and all("Not found in archive" in line for line in errors):
+        return 2
+    print(stderr)
+    return 1
+
+def restore_archive_chain(archive, target_dir, prefix=""):
+    archive = Path(archive).resolve()
+    suffix = next((extension for extension in CODEC_EXTENSIONS.values() if archive.name.endswith(extension)), "")
+    hostname = re.sub(r"-\d{2}-\d{2}-\d{4}.*$", "", archive.name)
+    backups = sorted(archive.parent.glob(f"{hostname}-*{suffix}"), key=os.path.getmtime)
+
+    # Walk back from the requested archive to the full archive its chain starts with
+    chain = [archive]
+    position = backups.index(archive)
+    while chain[0].name.endswith(f"{INCREMENTAL_SUFFIX}{suffix}") and position > 0:
+        position -= 1
+        chain.insert(0, backups[position])
+
+    os.makedirs(target_dir, exist_ok=True)
+    if prefix and SEEKABLE_INDEX:
+        result = restore_indexed(chain, target_dir, prefix)
+        if result is not None:
+            return result
+
+    found = False
+    for backup in chain:
+        print(f"Extracting {backup.name}")
+        result = extract_tar(backup, target_dir, prefix)
+        if result == 1:
+            return 1
+        found = found or result == 0
+
+        deleted_file = Path(f"{backup}{DELETED_SUFFIX}")
+        if deleted_file.exists():
+            with gzip.open(deleted_file, 'rt') as f_in:
+                for path in json.load(f_in):
+                    if prefix and not (path == prefix or path.startswith(prefix.rstrip('/') + '/')):
+                        continue
+                    destination = Path(target_dir) / path.lstrip('/')
+                    if destination.is_dir() and not destination.is_symlink():
+                        shutil.rmtree(destination)
+                    elif destination.is_symlink() or destination.exists():
+                        destination.unlink()
+
+    if not found:
+        print(f"{prefix} is not part of {archive.name} or the archives it is based on")
+        return 1
+
+    print(f"Restored {len(chain)} archives to {target_dir}")
+    return 0
+
+#
+## Sharding Functions
+#
+def partition_shards(entries, count):
+    # Largest files go first onto the currently smallest shard (LPT), every entry also costs a 512 byte tar header
+    heap = [(0, number) for number in range(count)]
+    assignment = {}
+    for path, size in sorted(entries, key=lambda entry: entry[1], reverse=True):
+        total, number = heapq.heappop(heap)
+        assignment[path] = number
+        heapq.heappush(heap, (total + size + 512, number))
+
+    # Members of a shard keep the walk order, so they stay grouped by directory
+    shards = [[] for _ in range(count)]
+    for path, size in entries:
+        shards[assignment[path]].append(path)
+    return shards
+
+def sharded_backup(hostname, date_str):
+    shard_dir = BACKUP_DIR / f"{hostname}-{date_str}{SHARD_SUFFIX}"
+    temp_dir = shard_dir.with_name(f".{shard_dir.name}.part")
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    temp_dir.mkdir()
+
+    entries = [(path, st.st_size if stat.S_ISREG(st.st_mode) else 0) for path, st in walk_paths()]
+    count = max(1, min(SHARD_COUNT, len(entries)))
+    shards = partition_shards(entries, count)
+    names = [f"shard-{number:03d}{CODEC_EXTENSIONS[COMPRESSION]}" for number in range(count)]
+    logging.info(f"Archiving {len(entries)} entries into {count} shards ({sum(size for path, size in entries) / 1024 / 1024:.0f} MB)")
+
+    start = time.monotonic()
+    failed = skipped = 0
+    with ProcessPoolExecutor(max_workers=count) as pool:
+        futures = {pool.submit(write_archive, temp_dir / names[number], shards[number]): number for number in range(count)}
+        for future in as_completed(futures):
+            number = futures[future]
+            try:
+                archived, shard_skipped, total_bytes = future.result()
+                skipped += shard_skipped
+                logging.info(f"Finished {names[number]}: {archived} entries ({total_bytes / 1024 / 1024:.0f} MB) after {time.monotonic() - start:.1f}s")
+            except Exception as e:
+                logging.error(f"Archiving {names[number]} failed: {e}")
+                failed += 1
+
+    if failed:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        notify_slack(f"System backup error: {failed} of {count} shards failed on {hostname}")
+        return None
+
+    # The shard index maps every archived path to its shard, restores of a single path only read that shard
+    with gzip.open(temp_dir / SHARD_INDEX, 'wt') as f_out:
+        f_out.write(json.dumps({"hostname": hostname, "created": datetime.now().isoformat(), "shards": names}) + "\n")
+        for number, paths in enumerate(shards):
+            for path in paths:
+                f_out.write(json.dumps([path, number]) + "\n")
+
+    shutil.rmtree(shard_dir, ignore_errors=True)
+    os.replace(temp_dir, shard_dir)
+    logging.info(f"Sharded backup {shard_dir} completed in {time.monotonic() - start:.1f}s, {skipped} skipped")
+
+    if skipped:
+        notify_slack(f"System backup warning: {skipped} paths could not be archived on {hostname}")
+    return shard_dir
+
+def restore_shards(shard_dir, target_dir, prefix=""):
+    shard_dir = Path(shard_dir)
+    with gzip.open(shard_dir / SHARD_INDEX, 'rt') as f_in:
+        names = json.loads(f_in.readline())["shards"]
+        if prefix:
+            needed = set()
+            for path, number in map(json.loads, f_in):
+                if path == prefix or path.startswith(prefix.rstrip('/') + '/'):
+                    needed.add(number)
+        else:
+            needed = set(range(len(names)))
+
+    if not needed:
+        print(f"{prefix} is not part of {shard_dir}")
+        return 1
+
+    os.makedirs(target_dir, exist_ok=True)
+    if prefix and SEEKABLE_INDEX and len(needed) == 1:
+        result = restore_indexed([shard_dir / names[min(needed)]], target_dir, prefix)
+        if result is not None:
+            return result
+
+    # The shard index lists the shards holding the prefix, so a member missing from one of them is an error as well
+    for number in sorted(needed):
+        print(f"Extracting {names[number]}")
+        if extract_tar(shard_dir / names[number], target_dir, prefix) != 0:
+            print(f"Extracting {names[number]} failed")
+            return 1
+
+    print(f"Restored {len(needed)} of {len(names)} shards to {target_dir}")
+    return 0
+
+#
+## Deduplication Functions
+#
+def find_chunk_cut(buffer, length):
+    if length <= CHUNK_MIN_SIZE:
+        return length
+
+    limit = min(length, CHUNK_MAX_SIZE)
+    for match in CHUNK_TRIGGER.finditer(buffer, CHUNK_MIN_SIZE, limit):
+        position = match.end()
+        if zlib.crc32(buffer[position - CHUNK_WINDOW:position]) & CHUNK_MASK == 0:
+            return position
+
+    return limit
+
+def read_chunks(path):
+    buffer = bytearray()
+    with open(path, 'rb') as f_in:
+        eof = False
+        while not eof or buffer:
+            while not eof and len(buffer) < CHUNK_MAX_SIZE:
+                data = f_in.read(CHUNK_MAX_SIZE)
+                eof = not data
+                buffer += data
+
+            if not buffer:
+                break
+            cut = find_chunk_cut(buffer, len(buffer))
+            yield bytes(buffer[:cut])
+            del buffer[:cut]
+
+def chunk_path(digest):
+    return CHUNK_DIR / digest[:2] / digest
+
+class ChunkStoreError(Exception):
+    # Raised when a chunk cannot be written, unlike unreadable source files this fails the whole run
+    pass
+
+def lock_chunk_store(operation):
+    # Backups hold a shared lock while they add chunks, garbage collection needs the exclusive one
+    CHUNK_DIR.mkdir(parents=True, exist_ok=True)
+    lock_file = open(CHUNK_DIR / ".lock", 'a+')
+    try:
+        fcntl.lockf(lock_file, operation)
+    except OSError:
+        lock_file.close()
+        raise
+    return lock_file
+
+def store_chunk(data):
+    digest = hashlib.sha256(data).hexdigest()
+    path = chunk_path(digest)
+    temp_path = path.with_name(f".{digest}.{os.getpid()}.tmp")
+
+    try:
+        if path.exists():
+            # Reused chunks are touched so the garbage collection grace window also covers them
+            os.utime(path)
+            return digest, False
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(temp_path, 'wb') as f_out:
+            f_out.write(zlib.compress(data, 6))
+        os.replace(temp_path, path)
+    except OSError as e:
+        temp_path.unlink(missing_ok=True)
+        raise ChunkStoreError(f"Unable to store chunk {digest}: {e}") from e
+
+    return digest, True
+
+def read_manifest(path):
+    with gzip.open(path, 'rt') as f_in:
+        header = json.loads(f_in.readline())
+        return header, [json.loads(line) for line in f_in]
+
+def dedup_backup(hostname, date_str):
+    manifest_file = BACKUP_DIR / f"{hostname}-{date_str}{MANIFEST_SUFFIX}"
+    temp_manifest = manifest_file.with_name(f".{manifest_file.name}.tmp")
+
+    # Unchanged files (same size, mtime and inode) reuse the chunk list from the previous run without being read
+    previous = {}
+    manifests = sorted(BACKUP_DIR.glob(f"{hostname}-*{MANIFEST_SUFFIX}"), key=os.path.getmtime, reverse=True)
+    if manifests:
+        logging.info(f"Using {manifests[0].name} as the previous manifest")
+        previous = {entry["path"]: entry for entry in read_manifest(manifests[0])[1] if entry["type"] == "file"}
+
+    files = reused = new_chunks = new_bytes = 0
+    try:
+        with lock_chunk_store(fcntl.LOCK_SH), gzip.open(temp_manifest, 'wt') as manifest:
+            manifest.write(json.dumps({"hostname": hostname, "created": datetime.now().isoformat(), "include": INCLUDE_PATHS}) + "\n")
+
+            for path, st in walk_paths():
+                entry = {"path": path, "mode": st.st_mode, "uid": st.st_uid, "gid": st.st_gid, "mtime_ns": st.st_mtime_ns}
+
+                if stat.S_ISDIR(st.st_mode):
+                    entry["type"] = "dir"
+                elif stat.S_ISLNK(st.st_mode):
+                    entry["type"] = "symlink"
+                    try:
+                        entry["target"] = os.readlink(path)
+                    except OSError as e:
+                        logging.error(f"Unable to read {path}: {e}")
+                        continue
+                elif stat.S_ISREG(st.st_mode):
+                    entry.update({"type": "file", "size": st.st_size, "inode": st.st_ino})
+                    old = previous.get(path)
+                    files += 1
+
+                    if old and (old["size"], old["mtime_ns"], old["inode"]) == (st.st_size, st.st_mtime_ns, st.st_ino):
+                        entry["chunks"] = old["chunks"]
+                        reused += 1
+                    else:
+                        # Only read errors skip the file, ChunkStoreError (e.g. a full disk) is not an OSError and aborts the run
+                        try:
+                            entry["chunks"] = []
+                            for data in read_chunks(path):
+                                digest, created = store_chunk(data)
+                                entry["chunks"].append(digest)
+                                if created:
+                                    new_chunks += 1
+                                    new_bytes += len(data)
+                        except OSError as e:
+                            logging.error(f"Unable to read {path}: {e}")
+                            continue
+                else:
+                    logging.info(f"Skipping special file: {path}")
+                    continue
+
+                manifest.write(json.dumps(entry) + "\n")
+    except BaseException:
+        temp_manifest.unlink(missing_ok=True)
+        raise
+
+    os.replace(temp_manifest, manifest_file)
+    logging.info(f"Wrote manifest {manifest_file} ({files} files, {reused} unchanged, {new_chunks} new chunks, {new_bytes} new bytes)")
+    return manifest_file
+
+def collect_garbage(backup_dir):
+    try:
+        lock = lock_chunk_store(fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        logging.info("Chunk store is in use by another backup, skipping garbage collection")
+        return
+
+    with lock:
+        # Chunks may be shared between hosts, so every manifest in the backup directory is taken into account
+        referenced = set()
+        for manifest in backup_dir.glob(f"*{MANIFEST_SUFFIX}"):
+            for entry in read_manifest(manifest)[1]:
+                referenced.update(entry.get("chunks", []))
+
+        # In-flight temp files and chunks younger than the grace window may belong to a manifest that is not written yet
+        cutoff = time.time() - CHUNK_GC_GRACE
+        removed = recent = 0
+        for path in CHUNK_DIR.glob("*/*"):
+            if path.name.endswith(".tmp") or path.name in referenced:
+                continue
+            try:
+                if path.stat().st_mtime > cutoff:
+                    recent += 1
+                    continue
+                path.unlink()
+                removed += 1
+            except FileNotFoundError:
+                continue
+
+    logging.info(f"Garbage collection removed {removed} unreferenced chunks ({len(referenced)} chunks in use, {recent} recent chunks kept)")
+
+def restore_dedup(manifest_file, target_dir, prefix=""):
+    target_dir = Path(target_dir)
+    directories = []
+    restored = 0
+
+    for entry in read_manifest(manifest_file)[1]:
+        if prefix and not (entry["path"] == prefix or entry["path"].startswith(prefix.rstrip('/') + '/')):
+            continue
+
+        destination = target_dir / entry["path"].lstrip('/')
+        destination.parent.mkdir(parents=True, exist_ok=True)
+
+        if entry["type"] == "dir":
+            destination.mkdir(exist_ok=True)
+            directories.append((destination, entry))
+            continue
+        elif entry["type"] == "symlink":
+            if destination.is_symlink() or destination.exists():
+                destination.unlink()
+            os.symlink(entry["target"], destination)
+        else:
+            with open(destination, 'wb') as f_out:
+                for digest in entry["chunks"]:
+                    f_out.write(zlib.decompress(chunk_path(digest).read_bytes()))
+            os.chmod(destination, stat.S_IMODE(entry["mode"]))
+            os.utime(destination, ns=(entry["mtime_ns"], entry["mtime_ns"]))
+
+        if os.geteuid() == 0:
+            os.lchown(destination, entry["uid"], entry["gid"])
+        restored += 1
+
+    # Directory metadata is applied last, restoring their content would change the mtime again
+    for destination, entry in reversed(directories):
+        os.chmod(destination, stat.S_IMODE(entry["mode"]))
+        os.utime(destination, ns=(entry["mtime_ns"], entry["mtime_ns"]))
+        if os.geteuid() == 0:
+            os.chown(destination, entry["uid"], entry["gid"])
+
+    if prefix and not restored and not directories:
+        print(f"{prefix} is not part of {manifest_file}")
+        return 1
+
+    print(f"Restored {restored} entries from {manifest_file} to {target_dir}")
+    return 0
+
 #
 ## Script Start point
 #
+def init_arg_parse():
+    args = argparse.ArgumentParser(description='Automated script that backs up Linux directories (for use in a cron job)', epilog="Written by unkn0wnAPI, part of sysadmin-scripts [https://github.com/unkn0wnapi/sysadmin-scripts]")
+    commands = args.add_subparsers(dest='command')
+
+    restore = commands.add_parser('restore', help='Restore files from an archive (including its incremental chain), a shard set or a "dedup" manifest')
+    restore.add_argument('backup', help='Archive, shard set directory or manifest file of the backup to restore')
+    restore.add_argument('target', help='Directory the files are restored into')
+    restore.add_argument('--path', '-p', action='store', dest='path', default='', help='Only restore this path (file or directory)')
+
+    return args.parse_args()
+
+def write_archive(archive_file, paths):
+    temp_file = archive_file.with_name(f".{archive_file.name}.part")
+    temp_index = archive_file.with_name(f".{archive_file.name}{INDEX_SUFFIX}.part")
+    archived = skipped = total_bytes = 0
+    index = []
+
+    try:
+        with ExitStack() as stack:
+            if SEEKABLE_INDEX:
+                # Regular (non-stream) tar mode, the member offsets are taken from the uncompressed position of the block writer
+                writer = BlockWriter(stack.enter_context(open(temp_file, 'wb', buffering=TAR_BUFFER_SIZE)))
+                stack.callback(writer.close)
+                tar = stack.enter_context(tarfile.open(fileobj=writer, mode="w", format=tarfile.PAX_FORMAT, copybufsize=TAR_BUFFER_SIZE))
+            else:
+                f_out = stack.enter_context(open_compressed(temp_file))
+                tar = stack.enter_context(tarfile.open(fileobj=f_out, mode="w|", format=tarfile.PAX_FORMAT, bufsize=TAR_BUFFER_SIZE))
+
+            for path in paths:
+                # Only paths that fail before anything is written are skipped, a failure inside addfile leaves a broken stream
+                try:
+                    info = tar.gettarinfo(path, arcname=path.lstrip('/'))
+                    f_in = open(path, 'rb') if info is not None and info.isreg() else None
+                except OSError as e:
+                    logging.error(f"Unable to archive {path}: {e}")
+                    skipped += 1
+                    continue
+
+                if info is None:
+                    logging.info(f"Skipping special file: {path}")
+                    continue
+
+                if SEEKABLE_INDEX:
+                    writer.next_block()
+                if f_in is not None:
+                    digest = hashlib.sha256() if SEEKABLE_INDEX else None
+                    with f_in:
+                        tar.addfile(info, PaddedReader(f_in, info.size, digest))
+                    if SEEKABLE_INDEX:
+                        data_start = tar.offset - -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+                        index.append([path, writer.block_offset, data_start - writer.block_start, info.size, int(info.mtime), info.mode, digest.hexdigest()])
+                else:
+                    tar.addfile(info)
+
+                archived += 1
+                total_bytes += info.size
+                if archived % PROGRESS_INTERVAL == 0:
+                    logging.info(f"Progress ({archive_file.name}): {archived} entries, {total_bytes / 1024 / 1024:.0f} MB archived")
+
+        if SEEKABLE_INDEX:
+            with gzip.open(temp_index, 'wt') as f_index:
+                f_index.write(json.dumps({"codec": COMPRESSION, "block_size": INDEX_BLOCK_SIZE, "files": len(index)}) + "\n")
+                for entry in index:
+                    f_index.write(json.dumps(entry) + "\n")
+    except BaseException:
+        temp_file.unlink(missing_ok=True)
+        temp_index.unlink(missing_ok=True)
+        raise
+
+    os.replace(temp_file, archive_file)
+    if SEEKABLE_INDEX:
+        os.replace(temp_index, f"{archive_file}{INDEX_SUFFIX}")
+    else:
+        Path(f"{archive_file}{INDEX_SUFFIX}").unlink(missing_ok=True)
+    return archived, skipped, total_bytes
+
+def archive_backup(hostname, date_str, paths=None, suffix="", overwrite=True):
+    backup_file = BACKUP_DIR / f"{hostname}-{date_str}{suffix}{CODEC_EXTENSIONS[COMPRESSION]}"
+    if not overwrite and (backup_file.exists() or Path(f"{backup_file}{DELETED_SUFFIX}").exists()):
+        # Replacing a member of an incremental chain would silently break every archive based on it
+        logging.error(f"{backup_file} already exists, refusing to overwrite it")
+        notify_slack(f"System backup error: {backup_file.name} already exists on {socket.gethostname()}")
+        return None
+    if paths is None:
+        paths = (path for path, st in walk_paths())
+
+    logging.info(f"Archiving into {backup_file}")
+    start = time.monotonic()
+
+    try:
+        archived, skipped, total_bytes = write_archive(backup_file, paths)
+    except Exception as e:
+        logging.error(f"Archiving into {backup_file} failed: {e}")
+        notify_slack(f"System backup error: archiving failed on {socket.gethostname()}")
+        return None
+
+    elapsed = time.monotonic() - start
+    logging.info(f"Archived {archived} entries ({total_bytes / 1024 / 1024:.0f} MB) in {elapsed:.1f}s "
+                 f"[{total_bytes / 1024 / 1024 / max(elapsed, 0.001):.1f} MB/s], {skipped} skipped")
+
+    if skipped:
+        notify_slack(f"System backup warning: {skipped} paths could not be archived on {socket.gethostname()}")
+    return backup_file
+
 def main():
+    args = init_arg_parse()
+    if args.command == 'restore':
+        if args.backup.endswith(MANIFEST_SUFFIX):
+            return restore_dedup(args.backup, args.target, args.path)
+        elif Path(args.backup).is_dir():
+            return restore_shards(args.backup, args.target, args.path)
+        return restore_archive_chain(args.backup, args.target, args.path)
+
     hostname = socket.gethostname()
     date_str = datetime.now().strftime('%d-%m-%Y')
-    backup_file = BACKUP_DIR / f"{hostname}-{date_str}.tgz"
+    if COMPRESSION not in CODEC_EXTENSIONS:
+        logging.error(f"Unknown COMPRESSION codec: {COMPRESSION}. Aborting backup.")
+        return 1
+    if BACKUP_MODE not in BACKUP_MODES:
+        logging.error(f"Unknown BACKUP_MODE: {BACKUP_MODE}. Aborting backup.")
+        return 1
 
     os.makedirs(BACKUP_DIR, exist_ok=True)
 
-    # Build tar command with exclusions
-    exclude_args = " ".join([f"--exclude='{path}'" for path in EXCLUDE_PATHS])
-    tar_command = f"tar -zcpvf {backup_file} {exclude_args} {' '.join(INCLUDE_PATHS)}"
-
-    if not shell_exec(tar_command, "Docker data tar backup"):
-        return 1
+    if BACKUP_MODE == "dedup":
+        try:
+            backup_file = dedup_backup(hostname, date_str)
+        except (OSError, ChunkStoreError) as e:
+            logging.error(f"Deduplicated backup failed: {e}")
+            notify_slack(f"System backup error: deduplicated backup failed on {hostname}")
+            return 1
+        suffixes = MANIFEST_SUFFIX
+    elif BACKUP_MODE == "incremental":
+        backup_file = incremental_backup(hostname, date_str)
+        if backup_file is None:
+            return 1
+        suffixes = tuple(CODEC_EXTENSIONS.values())
+    elif BACKUP_MODE == "sharded":
+        backup_file = sharded_backup(hostname, date_str)
+        if backup_file is None:
+            return 1
+        suffixes = SHARD_SUFFIX
+    else:
+        backup_file = archive_backup(hostname, date_str)
+        if backup_file is None:
+            return 1
+        suffixes = tuple(CODEC_EXTENSIONS.values())
 
     # Check backup file
     if not backup_file.exists() or backup_file.stat().st_size == 0:
@@ -106,10 +982,13 @@ def main():
         notify_slack(f"Docker backup failed: Archive is empty or missing on {hostname}")
         return 1
 
-    # Rotate old backups
-    rotate_backups(BACKUP_DIR, hostname)
+    # Rotate old backups, in "dedup" mode chunks no longer referenced by any manifest are removed afterwards
+    rotate_backups(BACKUP_DIR, hostname, suffixes)
+    if BACKUP_MODE == "dedup":
+        collect_garbage(BACKUP_DIR)
     logging.info("Backup rotation completed successfully.")
     logging.info("Docker backup completed successfully.")
+    return 0
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
@@ -9,9 +9,39 @@
 #
 ## Imports
 #
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import subprocess
 import argparse
+import ctypes
+import select
+import shutil
+import struct
+import sys
+import json
+import time
 import os
 
+#
+## Init configuration variable
+#
+JOURNAL_NAME = ".video_merger_journal.json"
+PROBE_CACHE_NAME = ".video_merger_probes.json"
+IGNORED_SUFFIXES = (".part", ".ytdl", ".temp", ".tmp")
+
+# Codecs an output container holds without re-encoding and the encoders used otherwise, containers not listed (e.g. mkv) accept everything
+MP4_CODECS = ({"h264", "hevc", "av1", "vp9", "mpeg4"}, {"aac", "mp3", "ac3", "eac3", "alac"}, "libx264", "aac")
+CONTAINER_CODECS = {
+    "mp4": MP4_CODECS,
+    "m4v": MP4_CODECS,
+    "mov": ({"h264", "hevc", "mpeg4", "prores"}, {"aac", "mp3", "alac", "pcm_s16le"}, "libx264", "aac"),
+    "webm": ({"vp8", "vp9", "av1"}, {"opus", "vorbis"}, "libvpx-vp9", "libopus"),
+}
+
+# inotify(7) event flags, yt-dlp renames finished downloads from ".part" to the final name
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+INOTIFY_EVENT = struct.Struct("iIII")
+
 #
 ## Functions
 #
@@ -19,14 +49,238 @@ def argumentParser():
     argParser = argparse.ArgumentParser(description=f'Merge separate audio & video files created by yt-dlp into one', epilog="Written by unkn0wnAPI, part of sysadmin-scripts [https://github.com/unkn0wnapi/sysadmin-scripts]")
     argParser.add_argument('input_directory', type=str, help='Input directory')
     argParser.add_argument('--video-ext', '-v', action='store', dest='vext', default="mp4", help='Sets video file extension [defaults to mp4]')
-    argParser.add_argument('--audio-ext', '-a', action='store', dest='aext', default="m4a", help='Sets audio file extension [defaults to m4a]')
+    argParser.add_argument('--audio-ext', '-a', action='store', dest='aext', default="m4a", help='Sets audio file extensions, ordered by preference (Delimiter: ",") [defaults to m4a]')
     argParser.add_argument('--target-ext', '-e', action='store', dest='fext', default="mp4", help='Sets output file extension [defaults to mp4]')
     argParser.add_argument('--output', '-o', action='store', dest='od', default='.', help='Output directory [defaults to current working directory]')
     argParser.add_argument('--create-output-subdir', action='store_true', dest='sb', help='Creates sub-directory in the output location, based on the top-directory name from input path')
+    argParser.add_argument('--resume', '-r', action='store_true', dest='resume', help='Skips merges already recorded in the journal whose input files did not change')
+    argParser.add_argument('--journal', action='store', dest='journal', default=None, help=f'Journal of completed merges [defaults to {JOURNAL_NAME} in the output directory]')
+    argParser.add_argument('--watch', '-w', action='store_true', dest='watch', help='Keeps running and merges new downloads as they land in the input directory (implies --resume)')
+    argParser.add_argument('--settle', action='store', type=float, dest='settle', default=5, help='Seconds without new files in the input directory before a watch run starts merging [defaults to 5]')
+    argParser.add_argument('--jobs', '-j', action='store', type=int, dest='jobs', default=os.cpu_count() or 1, help='Number of remuxes running at the same time [defaults to number of CPU cores]')
+    argParser.add_argument('--transcode-jobs', '-t', action='store', type=int, dest='transcode_jobs', default=1, help='Number of transcodes running at the same time, every ffmpeg encoder already uses multiple cores [defaults to 1]')
+    argParser.add_argument('--video-encoder', action='store', dest='vencoder', default=None, help='ffmpeg video encoder used when the video has to be transcoded, e.g. h264_nvenc or h264_qsv [defaults to libx264, libvpx-vp9 for webm]')
+    argParser.add_argument('--hwaccel', action='store', dest='hwaccel', default=None, help='ffmpeg hardware decoder used when the video has to be transcoded, e.g. auto or cuda [defaults to software decoding]')
     return argParser.parse_args()
 
-def ffmpeg_merger(input_video: str, input_audio: str, output_file: str):
-    os.system(f'ffmpeg -i "{input_video}" -i "{input_audio}" -c copy "{output_file}" >/dev/null 2>&1')
+def ffmpeg_merger(input_video: str, input_audio: str, output_file: str, codec_args: list, overwrite: bool = False, hwaccel: str = None) -> tuple:
+    # ffmpeg writes to a hidden temporary name (keeping the extension, it selects the container), an interrupted merge never leaves a truncated output
+    directory, name = os.path.split(output_file)
+    temp_file = os.path.join(directory, f".{os.path.splitext(name)[0]}.merging{os.path.splitext(name)[1]}")
+    start = time.monotonic()
+    if not overwrite and os.path.exists(output_file):
+        return 1, time.monotonic() - start, f"Output file {output_file} already exists"
+
+    # Argument list instead of a shell string, file names with quotes or "$" are passed to ffmpeg unchanged
+    command = ["ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "warning", "-y", *(["-hwaccel", hwaccel] if hwaccel else []),
+               "-i", input_video, "-i", input_audio, "-map", "0:v:0", "-map", "1:a:0", *codec_args, temp_file]
+    try:
+        result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, errors='replace')
+        if result.returncode == 0:
+            os.replace(temp_file, output_file)
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+    return result.returncode, time.monotonic() - start, result.stderr.strip()
+
+def split_name(file_name: str) -> tuple:
+    # yt-dlp names split streams as "name.format_id.ext", files without a format id use the whole stem as base name
+    stem, ext = os.path.splitext(file_name)
+    base, dot, format_id = stem.rpartition('.')
+    return (base, format_id, ext[1:]) if dot else (stem, "", ext[1:])
+
+def build_index(input_dir: str, video_ext: str, audio_exts: list, exclude: set = frozenset()) -> tuple:
+    # One scandir pass, every base name keeps its best video (largest file) and best audio (preferred extension, then largest file)
+    videos = {}
+    audios = {}
+    with os.scandir(input_dir) as entries:
+        for entry in entries:
+            # Hidden files are temporary merge outputs, excluded files are earlier merge outputs when input and output directory are the same
+            if not entry.is_file() or entry.name.startswith('.') or entry.name.endswith(IGNORED_SUFFIXES) or os.path.abspath(entry.path) in exclude:
+                continue
+
+            base, format_id, ext = split_name(entry.name)
+            if ext == video_ext:
+                rank = entry.stat().st_size
+                if base not in videos or rank > videos[base][0]:
+                    videos[base] = (rank, entry.path)
+            elif ext in audio_exts:
+                rank = (-audio_exts.index(ext), entry.stat().st_size)
+                if base not in audios or rank > audios[base][0]:
+                    audios[base] = (rank, entry.path)
+
+    pairs = [(base, video[1], audios[base][1]) for base, video in sorted(videos.items()) if base in audios]
+    unmatched_videos = sorted(video[1] for base, video in videos.items() if base not in audios)
+    unmatched_audios = sorted(audio[1] for base, audio in audios.items() if base not in videos)
+    return pairs, unmatched_videos, unmatched_audios
+
+def file_state(path: str) -> list:
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def load_json(json_file: str) -> dict:
+    try:
+        with open(json_file, 'r') as f_in:
+            return json.load(f_in)
+    except (OSError, ValueError):
+        return {}
+
+def save_json(json_file: str, data: dict):
+    # Replaced atomically, an interrupted run keeps the previous file
+    os.makedirs(os.path.dirname(json_file) or ".", exist_ok=True)
+    with open(f"{json_file}.tmp", 'w') as f_out:
+        json.dump(data, f_out, indent=2)
+    os.replace(f"{json_file}.tmp", json_file)
+
+def journal_entry(input_video: str, input_audio: str, output_file: str) -> dict:
+    return { "video": [os.path.abspath(input_video), *file_state(input_video)], "audio": [os.path.abspath(input_audio), *file_state(input_audio)], "output": file_state(output_file) }
+
+def is_merged(journal: dict, input_video: str, input_audio: str, output_file: str) -> bool:
+    entry = journal.get(os.path.abspath(output_file))
+    try:
+        return entry is not None and entry == journal_entry(input_video, input_audio, output_file)
+    except OSError:
+        return False
+
+def probe_file(path: str, cache: dict) -> dict:
+    # Codec of the first stream per type, cached by path, size and modification time so unchanged files are probed once
+    key = os.path.abspath(path)
+    state = file_state(path)
+    if key in cache and cache[key][0] == state:
+        return cache[key][1]
+
+    result = subprocess.run(["ffprobe", "-v", "error", "-print_format", "json", "-show_streams", path], capture_output=True, text=True, errors='replace')
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip() or f"ffprobe exited with code {result.returncode}")
+
+    codecs = {}
+    for stream in json.loads(result.stdout).get("streams", []):
+        codecs.setdefault(stream.get("codec_type"), stream.get("codec_name"))
+    cache[key] = [state, codecs]
+    return codecs
+
+def pick_strategy(input_video: str, input_audio: str, output_ext: str, video_encoder: str, cache: dict) -> tuple:
+    # Cheapest valid way to combine both streams: remux, transcode only the audio or transcode the video as well
+    video_codec = probe_file(input_video, cache).get("video")
+    audio_codec = probe_file(input_audio, cache).get("audio")
+    if video_codec is None:
+        raise RuntimeError(f"{os.path.basename(input_video)} has no video stream")
+    if audio_codec is None:
+        raise RuntimeError(f"{os.path.basename(input_audio)} has no audio stream")
+    if output_ext not in CONTAINER_CODECS:
+        return "remux", ["-c", "copy"]
+
+    video_codecs, audio_codecs, default_encoder, audio_encoder = CONTAINER_CODECS[output_ext]
+    audio_args = ["-c:a", "copy"] if audio_codec in audio_codecs else ["-c:a", audio_encoder]
+    if video_codec not in video_codecs:
+        return "transcode", ["-c:v", video_encoder or default_encoder, *audio_args]
+    if audio_codec not in audio_codecs:
+        return "audio transcode", ["-c:v", "copy", *audio_args]
+    return "remux", ["-c", "copy"]
+
+def watch_directory(input_dir: str, settle: float):
+    # Yields every time new files landed in input_dir and no further file showed up for "settle" seconds
+    libc = ctypes.CDLL(None, use_errno=True)
+    fd = libc.inotify_init1(os.O_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    try:
+        if libc.inotify_add_watch(fd, os.fsencode(input_dir), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {input_dir}")
+
+        pending = False
+        while True:
+            ready, _, _ = select.select([fd], [], [], settle if pending else None)
+            if not ready:
+                pending = False
+                yield
+                continue
+
+            data = os.read(fd, 64 * 1024)
+            offset = 0
+            while offset < len(data):
+                _, _, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                name = data[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + length].rstrip(b'\0').decode(errors='replace')
+                offset += INOTIFY_EVENT.size + length
+                if name and not name.startswith('.') and not name.endswith(IGNORED_SUFFIXES):
+                    pending = True
+    finally:
+        os.close(fd)
+
+def print_summary(results: list, elapsed: float, unmatched: int = 0, skipped: int = 0):
+    failed = [result for result in results if result[1] != 0]
+    merge_time = sum(result[2] for result in results)
+
+    print(f"\n[SUMMARY] Merged {len(results) - len(failed)}/{len(results)} files in {elapsed:.1f}s "
+          f"(ffmpeg time: {merge_time:.1f}s, speedup: {merge_time / max(elapsed, 0.001):.1f}x, already merged: {skipped}, unmatched files: {unmatched})")
+    for file_name, returncode, seconds, error in failed:
+        print(f"[FAILED] {file_name} (exit code {returncode}): {error.splitlines()[-1] if error else 'no error output'}")
+
+def merge_directory(args, INPUT_DIR: str, OUTPUT_DIR: str, VIDEO_EXT: str, AUDIO_EXTS: list, OUTPUT_EXT: str, JOURNAL_FILE: str, PROBE_CACHE_FILE: str, RESUME: bool):
+    journal = load_json(JOURNAL_FILE)
+    pairs, unmatched_videos, unmatched_audios = build_index(INPUT_DIR, VIDEO_EXT, AUDIO_EXTS, set(journal))
+    for file in unmatched_videos:
+        print(f"[SKIP] No matching audio file for {os.path.basename(file)}")
+    for file in unmatched_audios:
+        print(f"[SKIP] No matching video file for {os.path.basename(file)}")
+
+    merges = []
+    skipped = 0
+    for file_name, input_video, input_audio in pairs:
+        output_file = f"{OUTPUT_DIR}/{file_name}.{OUTPUT_EXT}"
+        if RESUME and is_merged(journal, input_video, input_audio, output_file):
+            skipped += 1
+            continue
+        # Outputs recorded in the journal were created by an earlier run, they are replaced when their inputs changed
+        merges.append((file_name, input_video, input_audio, output_file, RESUME and os.path.abspath(output_file) in journal))
+
+    if not merges and args.watch:
+        return 0
+
+    results = []
+    start = time.monotonic()
+    probe_cache = load_json(PROBE_CACHE_FILE)
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as probe_pool:
+        probes = [probe_pool.submit(pick_strategy, input_video, input_audio, OUTPUT_EXT, args.vencoder, probe_cache) for _, input_video, input_audio, _, _ in merges]
+    save_json(PROBE_CACHE_FILE, probe_cache)
+
+    # Remuxes are mostly I/O bound, transcodes keep all cores busy on their own, a separate smaller pool keeps cheap remuxes from waiting behind them
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as remux_pool, ThreadPoolExecutor(max_workers=max(1, args.transcode_jobs)) as transcode_pool:
+        futures = {}
+        for (file_name, input_video, input_audio, output_file, overwrite), probe in zip(merges, probes):
+            try:
+                strategy, codec_args = probe.result()
+            except (OSError, RuntimeError, ValueError) as error:
+                results.append((file_name, 1, 0.0, str(error)))
+                print(f"[FAIL] {file_name}.{OUTPUT_EXT} (probe failed): {error}")
+                continue
+
+            print(f"[FFMPEG] Merging {os.path.basename(input_video)} & {os.path.basename(input_audio)} -> {file_name}.{OUTPUT_EXT} ({strategy})")
+            pool = remux_pool if strategy == "remux" else transcode_pool
+            future = pool.submit(ffmpeg_merger, input_video=input_video, input_audio=input_audio, output_file=output_file, codec_args=codec_args,
+                                 overwrite=overwrite, hwaccel=args.hwaccel if strategy == "transcode" else None)
+            futures[future] = (file_name, input_video, input_audio, output_file, strategy)
+
+        for future in as_completed(futures):
+            file_name, input_video, input_audio, output_file, strategy = futures[future]
+            # A failing merge (e.g. ffmpeg could not be started or the output not be renamed) only fails its own group
+            try:
+                returncode, seconds, error = future.result()
+            except Exception as exception:
+                returncode, seconds, error = 1, 0.0, f"{type(exception).__name__}: {exception}"
+            results.append((file_name, returncode, seconds, error))
+            print(f"[{'DONE' if returncode == 0 else 'FAIL'}] {file_name}.{OUTPUT_EXT} ({strategy}, {seconds:.1f}s)")
+            for line in error.splitlines():
+                print(f"  {line}")
+
+            # Saved after every merge, an interrupted run only repeats the merges that were still running
+            if returncode == 0:
+                journal[os.path.abspath(output_file)] = journal_entry(input_video, input_audio, output_file)
+                save_json(JOURNAL_FILE, journal)
+
+    print_summary(results, time.monotonic() - start, len(unmatched_videos) + len(unmatched_audios), skipped)
+    return sum(1 for result in results if result[1] != 0)
 
 #
 ## Script Start point
@@ -34,10 +288,16 @@ def ffmpeg_merger(input_video: str, input_audio: str, output_file: str):
 def main():
     args = argumentParser()
     INPUT_DIR = args.input_directory
-    VIDEO_EXT = args.vext
-    AUDIO_EXT = args.aext
+    VIDEO_EXT = args.vext.removeprefix('.')
+    AUDIO_EXTS = [ext.strip().removeprefix('.') for ext in args.aext.split(',') if ext.strip()]
     OUTPUT_DIR = args.od
-    OUTPUT_EXT = args.fext
+    OUTPUT_EXT = args.fext.removeprefix('.')
+    RESUME = args.resume or args.watch
+
+    for binary in ("ffmpeg", "ffprobe"):
+        if shutil.which(binary) is None:
+            print(f"[ERROR] {binary} was not found in PATH")
+            return 1
 
     if args.sb == True:
         if OUTPUT_DIR[-1] != '/':
@@ -48,37 +308,26 @@ def main():
         else:
             OUTPUT_DIR += INPUT_DIR.split('/')[-1]
         
-        os.mkdir(OUTPUT_DIR)
+        os.makedirs(OUTPUT_DIR, exist_ok=True)
     
     INPUT_DIR = INPUT_DIR.removesuffix('/')
     OUTPUT_DIR = OUTPUT_DIR.removesuffix('/')
+    JOURNAL_FILE = args.journal or f"{OUTPUT_DIR}/{JOURNAL_NAME}"
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    PROBE_CACHE_FILE = f"{OUTPUT_DIR}/{PROBE_CACHE_NAME}"
 
-    FILES = os.listdir(INPUT_DIR)
-    AUDIO_QUALITY = ""
-
-    # Find audio quality suffix
-    for file in FILES:
-        file_name, file_ext = os.path.splitext(file)
-
-        if file_ext == f".{AUDIO_EXT}" and AUDIO_QUALITY == "":
-            AUDIO_QUALITY = (file_name[file_name.rfind('.'):]).replace('.', '')
-            break
-    
-    # Main loop for matching audio and video files
-    for file in FILES:
-        file_name, file_ext = os.path.splitext(file)
-
-        if file_ext != f".{VIDEO_EXT}":
-            continue
-
-        file_quality = file_name[file_name.rfind('.'):]
-        file_name = file_name.replace(file_quality, '')
-        
-        video_fullname = f"{file_name}{file_quality}.{VIDEO_EXT}"
-        audio_fullname = f"{file_name}.{AUDIO_QUALITY}.{AUDIO_EXT}"
+    # Any failed merge (also in a later watch run) makes the script exit non-zero
+    failed = merge_directory(args, INPUT_DIR, OUTPUT_DIR, VIDEO_EXT, AUDIO_EXTS, OUTPUT_EXT, JOURNAL_FILE, PROBE_CACHE_FILE, RESUME)
+    if not args.watch:
+        return 1 if failed else 0
 
-        print(f"[FFMPEG] Merging {VIDEO_EXT} & {AUDIO_EXT} -> {file_name}.mp4")
-        ffmpeg_merger(input_video=f"{INPUT_DIR}/{video_fullname}", input_audio=f"{INPUT_DIR}/{audio_fullname}", output_file=f"{OUTPUT_DIR}/{file_name}.{OUTPUT_EXT}")
+    print(f"[WATCH] Waiting for new downloads in {INPUT_DIR} (Ctrl+C to stop)")
+    try:
+        for _ in watch_directory(INPUT_DIR, args.settle):
+            failed += merge_directory(args, INPUT_DIR, OUTPUT_DIR, VIDEO_EXT, AUDIO_EXTS, OUTPUT_EXT, JOURNAL_FILE, PROBE_CACHE_FILE, RESUME)
+    except KeyboardInterrupt:
+        print("\n[WATCH] Stopped")
+    return 1 if failed else 0
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
@@ -6,10 +6,35 @@
 ## Information: Recover lost passwords from old Cisco network devices
 #
 
+#
+## Imports
+#
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, TextIO
+from collections import defaultdict
+from contextlib import nullcontext
+from itertools import accumulate
+import argparse
+import tempfile
+import hashlib
+import random
+import heapq
+import string
+import mmap
+import gzip
+import json
+import csv
+import time
+import sys
+import os
+import re
+
 #
 ## Configuration
 #
 PASSWORDS: list[str] = []
+READ_SIZE: int = 1024 * 1024
+INDEX_RUN_SIZE: int = 2 * 1024 * 1024
 
 #
 ## Global Variables
@@ -21,6 +46,21 @@ CISCO_KEYS: list[int] = [
     0x55, 0x42
 ]
 
+# Keystream of every seed, precomputed so decoding never indexes CISCO_KEYS per character
+KEY_TABLE_LENGTH: int = 128
+KEY_TABLE: list[bytes] = [bytes(CISCO_KEYS[(seed + i) % len(CISCO_KEYS)] for i in range(KEY_TABLE_LENGTH)) for seed in range(len(CISCO_KEYS))]
+SEED_KEYS: dict[str, bytes] = {f'{seed:02d}': KEY_TABLE[seed % len(CISCO_KEYS)] for seed in range(100)}
+
+# Wordlists are stored as 8 byte blake2b hashes of every password, big-endian so sorted bytes are sorted numbers
+HASH_SIZE: int = 8
+
+# Well known Type 7 strings, checked by the selftest command
+KNOWN_PASSWORDS: list[tuple[str, str]] = [('0822455D0A16', 'cisco'), ('094F471A1A0A', 'cisco')]
+
+# Every Type 7 secret of a config in one pass: "username x password 7", "enable password 7", "key 7", "key-string 7", "md5 7", ...
+TYPE7_PATTERN: re.Pattern = re.compile(rb'^([ \t]*)([^\r\n]*?\b(?:password|key|key-string|md5))[ \t]+7[ \t]+([0-9]{2}(?:[0-9A-Fa-f]{2})+)\b', re.MULTILINE)
+GZIP_MAGIC: bytes = b'\x1f\x8b'
+
 #
 ## Functions
 #
@@ -40,9 +80,524 @@ def type7_decryptor(passwd: list[str]) -> list[str]:
         decrypted_passwords.append(decrypted_password)
     return decrypted_passwords
 
+def type7_keystream(seed: int, length: int) -> bytes:
+    # Every KEY_TABLE row starts with a full rotation of CISCO_KEYS, longer keystreams repeat it
+    key = KEY_TABLE[seed % len(CISCO_KEYS)]
+    return key[:length] if length <= KEY_TABLE_LENGTH else (key[:len(CISCO_KEYS)] * (length // len(CISCO_KEYS) + 1))[:length]
+
+def type7_encrypt(plaintext: str | bytes, seed: int | None = None) -> str:
+    # IOS picks seeds 0 - 15, the two decimal digits allow up to 99, every character of a str has to fit into one byte (latin-1)
+    if seed is None:
+        seed = random.randint(0, 15)
+    elif not 0 <= seed <= 99:
+        raise ValueError(f'seed {seed} is out of range (0 - 99)')
+    data = plaintext if isinstance(plaintext, bytes) else plaintext.encode('latin-1')
+    return f'{seed:02d}{(int.from_bytes(data, "big") ^ int.from_bytes(type7_keystream(seed, len(data)), "big")).to_bytes(len(data), "big").hex().upper()}'
+
+def type7_decode(password: str) -> bytes:
+    # Raises ValueError for strings that are not Type 7 encrypted (seed or hex payload invalid)
+    if len(password) < 2 or not password[:2].isdigit():
+        raise ValueError(f'invalid seed "{password[:2]}"')
+    encrypted = bytes.fromhex(password[2:])
+    return (int.from_bytes(encrypted, 'big') ^ int.from_bytes(type7_keystream(int(password[:2]), len(encrypted)), 'big')).to_bytes(len(encrypted), 'big')
+
+def type7_decode_batch(passwords: list[str]) -> list[bytes | None]:
+    # The whole batch is decoded with one bytes.fromhex() and one integer XOR, per password only the keystream lookup and a slice remain
+    try:
+        lengths = [(len(password) - 2) >> 1 for password in passwords]
+        encrypted = bytes.fromhex(''.join([password[2:] for password in passwords]))
+        keystream = b''.join([SEED_KEYS[password[:2]][:length] for password, length in zip(passwords, lengths)])
+        # Odd length, too short or too long passwords make the sizes differ, as the batch can't be split reliably it is decoded one by one
+        if len(encrypted) != sum(lengths) or len(keystream) != len(encrypted):
+            raise ValueError('unaligned batch')
+    except (KeyError, ValueError):
+        decoded = []
+        for password in passwords:
+            try:
+                decoded.append(type7_decode(password))
+            except ValueError:
+                decoded.append(None)
+        return decoded
+
+    plaintext = (int.from_bytes(encrypted, 'big') ^ int.from_bytes(keystream, 'big')).to_bytes(len(encrypted), 'big')
+    return [plaintext[end - length:end] for end, length in zip(accumulate(lengths), lengths)]
+
+def read_inputs(files: list[str], encoding: str = 'ascii') -> Iterator[list[str]]:
+    # Yields about READ_SIZE bytes of lines at a time, every chunk is decoded as one batch
+    for file in files or ['-']:
+        if file == '-':
+            sys.stdin.reconfigure(encoding=encoding, errors='replace')
+        with (nullcontext(sys.stdin) if file == '-' else open(file, 'r', encoding=encoding, errors='replace')) as f_in:
+            while lines := f_in.readlines(READ_SIZE):
+                yield lines
+
+def type7_decode_stream(chunks: Iterable[list[str]]) -> Iterator[list[tuple[str, bytes | None]]]:
+    # The last field of every line is decoded, so plain lists and config lines like "password 7 <hash>" both work
+    for lines in chunks:
+        # Plain lists (one password per line, no comments) are split in one call
+        text = ''.join(lines)
+        if ' ' in text or '\t' in text or '#' in text:
+            passwords = [line.rsplit(None, 1)[-1] for line in lines if not line.isspace() and not line.lstrip().startswith('#')]
+        else:
+            passwords = text.split()
+        if passwords:
+            yield list(zip(passwords, type7_decode_batch(passwords)))
+
+def write_results(batches: Iterable[list[tuple[str, bytes | None]]], output_format: str, f_out: TextIO) -> tuple[int, int]:
+    decoded = failed = 0
+    writer = csv.writer(f_out) if output_format == 'csv' else None
+    if writer:
+        writer.writerow(['encrypted', 'plaintext'])
+    encode_json = json.JSONEncoder().encode
+
+    # One write call per batch instead of one per password, latin-1 maps every byte to the same character chr() returns in type7_decryptor()
+    for batch in batches:
+        rows = [(encrypted, plaintext.decode('latin-1')) for encrypted, plaintext in batch if plaintext is not None]
+        for encrypted, plaintext in batch:
+            if plaintext is None:
+                print(f'[ERROR] "{encrypted}" is not a valid Type 7 password', file=sys.stderr)
+
+        decoded += len(rows)
+        failed += len(batch) - len(rows)
+        if output_format == 'csv':
+            writer.writerows(rows)
+        elif output_format == 'jsonl':
+            f_out.writelines([f'{{"encrypted": {encode_json(encrypted)}, "plaintext": {encode_json(plaintext)}}}\n' for encrypted, plaintext in rows])
+        else:
+            f_out.writelines([f'{encrypted} -> {plaintext}\n' for encrypted, plaintext in rows])
+
+    return decoded, failed
+
+def config_context(data: bytes, line_start: int, indent: bytes, statement: bytes) -> str:
+    # Top level statements are their own context, indented ones belong to the section they are in (e.g. "line vty 0 4")
+    words = statement.decode('latin-1').split()
+    if not indent:
+        if words[0] in ('username', 'snmp-server'):
+            return ' '.join(words[:2])
+        return words[0] if words[0] == 'enable' else ' '.join(words[:-1]) or words[0]
+
+    section_start = line_start
+    while section_start > 0:
+        section_start = data.rfind(b'\n', 0, section_start - 1) + 1
+        if data[section_start:section_start + 1] not in (b' ', b'\t', b'\n', b'\r'):
+            break
+
+    # "!" closes a section, an indented line without a section header keeps its own statement as context
+    section = data[section_start:data.find(b'\n', section_start, line_start)].decode('latin-1').strip()
+    return ' '.join(words[:-1]) or words[0] if section_start == line_start or section.startswith('!') else section
+
+def scan_data(data: bytes) -> list[tuple[int, str, str]]:
+    findings: list[tuple[int, str, str]] = []
+    line_number = 1
+    position = 0
+    for match in TYPE7_PATTERN.finditer(data):
+        # Matches come in file order, so line numbers are counted incrementally (slices, as mmap objects have no count())
+        line_number += data[position:match.start()].count(b'\n')
+        position = match.start()
+        findings.append((line_number, config_context(data, match.start(), match.group(1), match.group(2)), match.group(3).decode('ascii')))
+    return findings
+
+def scan_file(path: str) -> tuple[str, list[tuple[int, str, str, str]], str | None]:
+    # Runs in a worker process, plain configs are memory-mapped instead of read, gzipped ones are decompressed in memory
+    try:
+        with open(path, 'rb') as f_in:
+            if os.fstat(f_in.fileno()).st_size == 0:
+                return path, [], None
+            with mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if data[:2] == GZIP_MAGIC:
+                    findings = scan_data(gzip.decompress(data))
+                else:
+                    findings = scan_data(data)
+    except (OSError, EOFError, gzip.BadGzipFile) as error:
+        return path, [], str(error)
+
+    plaintexts = type7_decryptor([encrypted for _, _, encrypted in findings])
+    return path, [(line_number, context, encrypted, plaintext) for (line_number, context, encrypted), plaintext in zip(findings, plaintexts)], None
+
+def find_configs(paths: list[str]) -> Iterator[str]:
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            yield from (os.path.join(root, file) for file in sorted(files))
+
+def write_findings(findings: Iterable[tuple[str, int, str, str, str]], output_format: str, f_out: TextIO):
+    if output_format == 'csv':
+        writer = csv.writer(f_out)
+        writer.writerow(['file', 'line', 'context', 'encrypted', 'plaintext'])
+        writer.writerows(findings)
+    elif output_format == 'jsonl':
+        f_out.writelines([f'{json.dumps({"file": file, "line": line_number, "context": context, "encrypted": encrypted, "plaintext": plaintext})}\n'
+                          for file, line_number, context, encrypted, plaintext in findings])
+    else:
+        f_out.writelines([f'{file}:{line_number} [{context}] {encrypted} -> {plaintext}\n' for file, line_number, context, encrypted, plaintext in findings])
+
+def password_hash(password: bytes) -> bytes:
+    return hashlib.blake2b(password, digest_size=HASH_SIZE).digest()
+
+def read_wordlist(path: str) -> Iterator[bytes]:
+    # Raw bytes, so wordlists in any encoding match the decoded bytes of a device
+    with open(path, 'rb') as f_in:
+        for line in f_in:
+            password = line.rstrip(b'\r\n')
+            if password:
+                yield password
+
+def load_wordlist(paths: list[str]) -> set[bytes]:
+    # Only the hashes are kept, a set of 8 byte values instead of the (longer) password strings
+    return {password_hash(password) for path in paths for password in read_wordlist(path)}
+
+def read_hashes(path: str) -> Iterator[bytes]:
+    with open(path, 'rb') as f_in:
+        while chunk := f_in.read(HASH_SIZE * 8192):
+            yield from (chunk[i:i + HASH_SIZE] for i in range(0, len(chunk), HASH_SIZE))
+
+def build_hash_index(wordlists: list[str], index_file: str) -> int:
+    # External sort: sorted runs of INDEX_RUN_SIZE hashes are written to temporary files and merged, so wordlists larger than memory work
+    runs: list[str] = []
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(index_file))) as workdir:
+        hashes: list[bytes] = []
+        for path in wordlists:
+            for password in read_wordlist(path):
+                hashes.append(password_hash(password))
+                if len(hashes) >= INDEX_RUN_SIZE:
+                    runs.append(write_run(workdir, len(runs), hashes))
+                    hashes = []
+        if hashes or not runs:
+            runs.append(write_run(workdir, len(runs), hashes))
+
+        count = 0
+        previous = None
+        batch: list[bytes] = []
+        with open(f"{index_file}.tmp", 'wb') as f_out:
+            for digest in heapq.merge(*[read_hashes(run) for run in runs]):
+                if digest == previous:
+                    continue
+                previous = digest
+                batch.append(digest)
+                if len(batch) >= 65536:
+                    f_out.write(b''.join(batch))
+                    count += len(batch)
+                    batch.clear()
+            f_out.write(b''.join(batch))
+            count += len(batch)
+        os.replace(f"{index_file}.tmp", index_file)
+    return count
+
+def write_run(workdir: str, number: int, hashes: list[bytes]) -> str:
+    path = os.path.join(workdir, f"run{number}")
+    hashes.sort()
+    with open(path, 'wb') as f_out:
+        f_out.write(b''.join(hashes))
+    return path
+
+class HashIndex:
+    # Memory-mapped index created by build-index, blake2b hashes are uniformly distributed, so the position of a hash is
+    # estimated from its value (interpolation search), a lookup reads a few records no matter how large the wordlist is
+    def __init__(self, path: str):
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        if size % HASH_SIZE:
+            raise ValueError(f'{path} is not a hash index (size is not a multiple of {HASH_SIZE})')
+        self.count = size // HASH_SIZE
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+
+    def value(self, position: int) -> int:
+        return int.from_bytes(self.data[position * HASH_SIZE:(position + 1) * HASH_SIZE], 'big')
+
+    def __contains__(self, digest: bytes) -> bool:
+        # The values next to the searched range are known from earlier probes (or the smallest/largest possible hash), one read per step
+        target = int.from_bytes(digest, 'big')
+        low, high = 0, self.count - 1
+        below, above = -1, 1 << (HASH_SIZE * 8)
+        while low <= high:
+            middle = min(high, max(low, low - 1 + (target - below) * (high - low + 2) // (above - below)))
+            value = self.value(middle)
+            if value == target:
+                return True
+            elif value < target:
+                low, below = middle + 1, value
+            else:
+                high, above = middle - 1, value
+        return False
+
+    def __len__(self) -> int:
+        return self.count
+
+    def close(self):
+        if self.count:
+            self.data.close()
+        self.file.close()
+
+def audit_findings(findings: list[tuple[str, int, str, str, str]], wordlist, min_reuse: int) -> list[tuple[str, int, str, str, str, bool, int]]:
+    # Reuse is counted per device (config file), a password used for several lines of one device is not reused
+    devices: dict[str, set[str]] = defaultdict(set)
+    for file, _, _, _, plaintext in findings:
+        devices[plaintext].add(file)
+
+    offenders = []
+    for file, line_number, context, encrypted, plaintext in findings:
+        in_wordlist = wordlist is not None and password_hash(plaintext.encode('latin-1')) in wordlist
+        reuse = len(devices[plaintext])
+        if in_wordlist or reuse >= min_reuse:
+            offenders.append((file, line_number, context, encrypted, plaintext, in_wordlist, reuse))
+    return offenders
+
+def write_offenders(offenders: list[tuple[str, int, str, str, str, bool, int]], output_format: str, f_out: TextIO):
+    if output_format == 'csv':
+        writer = csv.writer(f_out)
+        writer.writerow(['file', 'line', 'context', 'encrypted', 'plaintext', 'in_wordlist', 'devices'])
+        writer.writerows(offenders)
+    elif output_format == 'jsonl':
+        f_out.writelines([f'{json.dumps({"file": file, "line": line_number, "context": context, "encrypted": encrypted, "plaintext": plaintext, "in_wordlist": in_wordlist, "devices": reuse})}\n'
+                          for file, line_number, context, encrypted, plaintext, in_wordlist, reuse in offenders])
+    else:
+        f_out.writelines([f'{file}:{line_number} [{context}] {plaintext} ({", ".join(reason for reason in ("in wordlist" if in_wordlist else "", f"used on {reuse} devices" if reuse > 1 else "") if reason)})\n'
+                          for file, line_number, context, encrypted, plaintext, in_wordlist, reuse in offenders])
+
+def init_arg_parse():
+    args = argparse.ArgumentParser(description='Recover lost passwords from old Cisco network devices', epilog="Written by unkn0wnAPI, part of sysadmin-scripts [https://github.com/unkn0wnapi/sysadmin-scripts]")
+    commands = args.add_subparsers(dest='command')
+
+    decode = commands.add_parser('decode', help='Decode Type 7 passwords from files or stdin, one password (or "password 7 <hash>" line) per line')
+    decode.add_argument('files', nargs='*', help='Files with encrypted passwords, "-" reads stdin [defaults to stdin]')
+    decode.add_argument('--format', '-f', action='store', dest='format', choices=['text', 'csv', 'jsonl'], default='text', help='Output format [defaults to text]')
+    decode.add_argument('--output', '-o', action='store', dest='output', default=None, help='Output file [defaults to stdout]')
+
+    encode = commands.add_parser('encode', help='Encrypt plain text passwords from files or stdin (one per line) to Type 7 for bulk provisioning')
+    encode.add_argument('files', nargs='*', help='Files with plain text passwords, "-" reads stdin [defaults to stdin]')
+    encode.add_argument('--seed', '-s', action='store', type=int, dest='seed', default=None, help='Seed used for every password (0 - 99) [defaults to a random seed (0 - 15) per password]')
+    encode.add_argument('--format', '-f', action='store', dest='format', choices=['text', 'csv', 'jsonl'], default='text', help='Output format [defaults to text]')
+    encode.add_argument('--output', '-o', action='store', dest='output', default=None, help='Output file [defaults to stdout]')
+
+    selftest = commands.add_parser('selftest', help='Check that random passwords survive an encrypt/decrypt round trip with every decoder')
+    selftest.add_argument('--count', '-c', action='store', type=int, dest='count', default=10000, help='Number of random passwords [defaults to 10000]')
+    selftest.add_argument('--seed', '-s', action='store', type=int, dest='seed', default=None, help='Seed of the random generator, failures are reproducible with the same seed [defaults to a random seed]')
+
+    benchmark = commands.add_parser('benchmark', help='Compare the decode speed of the per-character and the batch implementation')
+    benchmark.add_argument('--count', '-c', action='store', type=int, dest='count', default=200000, help='Number of generated passwords [defaults to 200000]')
+    benchmark.add_argument('--repeat', '-r', action='store', type=int, dest='repeat', default=3, help='Runs per implementation, the fastest one is reported [defaults to 3]')
+    benchmark.add_argument('--min-speedup', action='store', type=float, dest='min_speedup', default=0, help='Exit with an error when the batch decoder is less than this many times faster than type7_decryptor() [defaults to 0 (disabled)]')
+    benchmark.add_argument('--json', action='store_true', dest='json', help='Print results as JSON instead of a table')
+
+    scan = commands.add_parser('scan', help='Extract and decode every Type 7 secret from saved device configs (plain or gzipped)')
+    scan.add_argument('paths', nargs='+', help='Config files or directories (searched recursively)')
+    scan.add_argument('--format', '-f', action='store', dest='format', choices=['text', 'csv', 'jsonl'], default='text', help='Output format [defaults to text]')
+    scan.add_argument('--output', '-o', action='store', dest='output', default=None, help='Output file [defaults to stdout]')
+    scan.add_argument('--jobs', '-j', action='store', type=int, dest='jobs', default=os.cpu_count() or 1, help='Number of configs scanned at the same time [defaults to number of CPU cores]')
+
+    audit = commands.add_parser('audit', help='Report decoded passwords of saved device configs that are in a wordlist or reused across devices')
+    audit.add_argument('paths', nargs='+', help='Config files or directories (searched recursively)')
+    wordlists = audit.add_mutually_exclusive_group()
+    wordlists.add_argument('--wordlist', '-w', action='append', dest='wordlist', default=[], help='Wordlist loaded into memory (one password per line), can be used multiple times')
+    wordlists.add_argument('--index', '-i', action='store', dest='index', default=None, help='Hash index created by build-index, used for multi-GB wordlists')
+    audit.add_argument('--min-reuse', '-m', action='store', type=int, dest='min_reuse', default=2, help='Number of devices sharing a password to report it as reused [defaults to 2]')
+    audit.add_argument('--format', '-f', action='store', dest='format', choices=['text', 'csv', 'jsonl'], default='text', help='Output format [defaults to text]')
+    audit.add_argument('--output', '-o', action='store', dest='output', default=None, help='Output file [defaults to stdout]')
+    audit.add_argument('--jobs', '-j', action='store', type=int, dest='jobs', default=os.cpu_count() or 1, help='Number of configs scanned at the same time [defaults to number of CPU cores]')
+
+    build_index = commands.add_parser('build-index', help='Build a sorted hash index of wordlists for the audit command')
+    build_index.add_argument('wordlists', nargs='+', help='Wordlists (one password per line)')
+    build_index.add_argument('--output', '-o', action='store', dest='output', required=True, help='Index file')
+
+    return args.parse_args()
+
+def bulk_decode(args) -> int:
+    with (open(args.output, 'w', newline='') if args.output else nullcontext(sys.stdout)) as f_out:
+        decoded, failed = write_results(type7_decode_stream(read_inputs(args.files)), args.format, f_out)
+
+    print(f'[INFO] Decoded {decoded} passwords, {failed} invalid entries skipped', file=sys.stderr)
+    return 1 if failed else 0
+
+def bulk_encode(args) -> int:
+    encoded = failed = 0
+    encode_json = json.JSONEncoder().encode
+    # Passwords are encrypted as their UTF-8 bytes, the bytes a terminal would send to the device
+    with (open(args.output, 'w', newline='') if args.output else nullcontext(sys.stdout)) as f_out:
+        writer = csv.writer(f_out) if args.format == 'csv' else None
+        if writer:
+            writer.writerow(['plaintext', 'encrypted'])
+
+        for lines in read_inputs(args.files, 'utf-8'):
+            rows = []
+            for line in lines:
+                plaintext = line.rstrip('\r\n')
+                if not plaintext:
+                    continue
+                try:
+                    rows.append((plaintext, type7_encrypt(plaintext.encode('utf-8'), args.seed)))
+                except ValueError as error:
+                    print(f'[ERROR] Unable to encrypt "{plaintext}": {error}', file=sys.stderr)
+                    failed += 1
+
+            encoded += len(rows)
+            if writer:
+                writer.writerows(rows)
+            elif args.format == 'jsonl':
+                f_out.writelines([f'{{"plaintext": {encode_json(plaintext)}, "encrypted": {encode_json(encrypted)}}}\n' for plaintext, encrypted in rows])
+            else:
+                f_out.writelines([f'{plaintext} -> {encrypted}\n' for plaintext, encrypted in rows])
+
+    print(f'[INFO] Encrypted {encoded} passwords, {failed} entries failed', file=sys.stderr)
+    return 1 if failed else 0
+
+def run_selftest(args) -> int:
+    seed = args.seed if args.seed is not None else random.randrange(2 ** 32)
+    rng = random.Random(seed)
+    failures: list[str] = []
+    print(f'[INFO] Running selftest with {args.count} random passwords (seed {seed})')
+
+    for encrypted, plaintext in KNOWN_PASSWORDS:
+        if type7_decryptor([encrypted]) != [plaintext] or type7_decode(encrypted) != plaintext.encode('latin-1') or type7_encrypt(plaintext, int(encrypted[:2])) != encrypted:
+            failures.append(f'known password {encrypted} -> {plaintext}')
+
+    # Lengths beyond KEY_TABLE_LENGTH cover the repeated keystream, seeds above 25 the wrap around of CISCO_KEYS
+    plaintexts = [''.join(chr(rng.randint(0, 255)) for _ in range(rng.randint(0, KEY_TABLE_LENGTH + 40))) for _ in range(args.count)]
+    encrypted = [type7_encrypt(plaintext, rng.randint(0, 99)) for plaintext in plaintexts]
+    for plaintext, password in zip(plaintexts, encrypted):
+        if type7_decryptor([password]) != [plaintext] or type7_decode(password) != plaintext.encode('latin-1'):
+            failures.append(f'round trip of {plaintext!r} -> {password}')
+
+    # Passwords longer than KEY_TABLE_LENGTH or invalid entries make the batch fall back to decoding one by one, both paths are checked
+    expected = [plaintext.encode('latin-1') for plaintext in plaintexts]
+    short = [(password, plaintext) for password, plaintext in zip(encrypted, expected) if len(plaintext) <= KEY_TABLE_LENGTH]
+    if type7_decode_batch([password for password, _ in short]) != [plaintext for _, plaintext in short]:
+        failures.append('batch decoding of valid passwords')
+    if type7_decode_batch(encrypted + ['0822455D0A1']) != expected + [None]:
+        failures.append('batch decoding with long and invalid passwords')
+    if len({type7_encrypt('cisco')[:2] for _ in range(1000)}) < 2 or any(not 0 <= int(type7_encrypt('cisco')[:2]) <= 15 for _ in range(1000)):
+        failures.append('random seeds')
+
+    for failure in failures[:20]:
+        print(f'[FAIL] {failure}')
+    if failures:
+        print(f'[ERROR] Selftest failed with {len(failures)} errors (seed {seed})')
+        return 1
+    print('[OK] All checks passed')
+    return 0
+
+def run_benchmark(args) -> int:
+    rng = random.Random(1337)
+    alphabet = string.ascii_letters + string.digits + string.punctuation
+    passwords = [type7_encrypt(''.join(rng.choices(alphabet, k=rng.randint(8, 24))), rng.randint(0, 15)) for _ in range(args.count)]
+    plaintexts = type7_decryptor(passwords)
+    batch_size = 65536
+
+    implementations = [
+        ('type7_decryptor', lambda: type7_decryptor(passwords)),
+        ('type7_decode', lambda: [type7_decode(password) for password in passwords]),
+        ('type7_decode_batch', lambda: [plaintext for i in range(0, len(passwords), batch_size) for plaintext in type7_decode_batch(passwords[i:i + batch_size])]),
+        ('type7_encrypt', lambda: [type7_encrypt(plaintext, 0) for plaintext in plaintexts]),
+    ]
+
+    results = []
+    for name, function in implementations:
+        timings = []
+        for _ in range(max(1, args.repeat)):
+            start = time.perf_counter()
+            function()
+            timings.append(time.perf_counter() - start)
+        results.append({ "implementation": name, "passwords": len(passwords), "seconds": round(min(timings), 4), "passwords_per_second": round(len(passwords) / max(min(timings), 1e-9)) })
+
+    baseline = results[0]["seconds"]
+    for result in results:
+        result["speedup"] = round(baseline / max(result["seconds"], 1e-9), 2)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        header = f"{'IMPLEMENTATION':<20} {'SECONDS':>9} {'PASSWORDS/s':>12} {'SPEEDUP':>8}"
+        print(header)
+        print('-' * len(header))
+        for result in results:
+            print(f"{result['implementation']:<20} {result['seconds']:>9} {result['passwords_per_second']:>12} {result['speedup']:>7}x")
+
+    batch_speedup = next(result["speedup"] for result in results if result["implementation"] == 'type7_decode_batch')
+    if batch_speedup < args.min_speedup:
+        print(f'[ERROR] Batch decoder is only {batch_speedup}x faster than type7_decryptor(), expected at least {args.min_speedup}x', file=sys.stderr)
+        return 1
+    return 0
+
+def collect_findings(paths: list[str], jobs: int) -> tuple[list[tuple[str, int, str, str, str]], int, int]:
+    findings: list[tuple[str, int, str, str, str]] = []
+    scanned = failed = 0
+    with ProcessPoolExecutor(max_workers=max(1, jobs)) as pool:
+        for path, file_findings, error in pool.map(scan_file, find_configs(paths), chunksize=16):
+            if error:
+                print(f'[ERROR] Unable to scan {path}: {error}', file=sys.stderr)
+                failed += 1
+                continue
+            scanned += 1
+            findings.extend((path, *finding) for finding in file_findings)
+    return findings, scanned, failed
+
+def scan_configs(args) -> int:
+    findings, scanned, failed = collect_findings(args.paths, args.jobs)
+
+    with (open(args.output, 'w', newline='') if args.output else nullcontext(sys.stdout)) as f_out:
+        write_findings(findings, args.format, f_out)
+
+    print(f'[INFO] Found {len(findings)} Type 7 secrets in {scanned} configs, {failed} configs failed', file=sys.stderr)
+    return 1 if failed else 0
+
+def audit_configs(args) -> int:
+    wordlist = None
+    try:
+        if args.index:
+            wordlist = HashIndex(args.index)
+        elif args.wordlist:
+            wordlist = load_wordlist(args.wordlist)
+    except (OSError, ValueError) as error:
+        print(f'[ERROR] Unable to load wordlist: {error}', file=sys.stderr)
+        return 1
+    if wordlist is not None:
+        print(f'[INFO] Loaded {len(wordlist)} wordlist hashes', file=sys.stderr)
+
+    try:
+        findings, scanned, failed = collect_findings(args.paths, args.jobs)
+        offenders = audit_findings(findings, wordlist, args.min_reuse)
+    finally:
+        if isinstance(wordlist, HashIndex):
+            wordlist.close()
+
+    with (open(args.output, 'w', newline='') if args.output else nullcontext(sys.stdout)) as f_out:
+        write_offenders(offenders, args.format, f_out)
+
+    print(f'[INFO] {len(offenders)} of {len(findings)} Type 7 secrets in {scanned} configs are weak or reused '
+          f'({sum(1 for offender in offenders if offender[5])} in wordlist, {sum(1 for offender in offenders if offender[6] >= args.min_reuse)} reused), {failed} configs failed', file=sys.stderr)
+    return 1 if failed else 0
+
+def build_index_file(args) -> int:
+    start = time.perf_counter()
+    try:
+        count = build_hash_index(args.wordlists, args.output)
+    except OSError as error:
+        print(f'[ERROR] Unable to build index: {error}', file=sys.stderr)
+        return 1
+    print(f'[INFO] Wrote {count} unique password hashes to {args.output} in {time.perf_counter() - start:.1f}s')
+    return 0
+
 def main() -> None:
     global PASSWORDS
 
+    args = init_arg_parse()
+    if args.command == 'decode':
+        return bulk_decode(args)
+    elif args.command == 'encode':
+        return bulk_encode(args)
+    elif args.command == 'selftest':
+        return run_selftest(args)
+    elif args.command == 'benchmark':
+        return run_benchmark(args)
+    elif args.command == 'scan':
+        return scan_configs(args)
+    elif args.command == 'audit':
+        return audit_configs(args)
+    elif args.command == 'build-index':
+        return build_index_file(args)
+
     print('===Cisco Password-Encryption (Type 7) Decryptor===')
 
     if len(PASSWORDS) == 0:
@@ -57,4 +612,4 @@ def main() -> None:
         print(f' - {PASSWORDS[x]} -> {decrypted_passwords[x]}')
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    sys.exit(main())
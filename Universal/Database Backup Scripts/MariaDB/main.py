@@ -12,11 +12,13 @@
 from datetime import datetime
 from pathlib import Path
 import subprocess
+import importlib
 import requests
 import logging
 import socket
 import shutil
 import gzip
+import lzma
 import os
 
 #
@@ -28,6 +30,13 @@ SLACK_WEBHOOK: str = "https://hooks.slack.com/services/your/webhook/url"
 DATABASES: list[str] = ["your_db1", "your_db2"]  # Set to [] to use --all-databases
 MAX_BACKUPS: int = 7
 # The connection settings MUST BE SET in the .my.cnf file for the user running this script
+COMPRESSION: str = "gzip"  # "gzip", "zstd", "xz", "lz4" or "none" (zstd/lz4 require the zstandard/lz4 python packages)
+COMPRESSION_LEVEL: int | None = None  # None uses the codec default (gzip: 6, zstd: 3, xz: 6, lz4: 0)
+COMPRESSION_THREADS: int = 0  # zstd worker threads, 0 uses all CPU cores
+
+CODEC_EXTENSIONS: dict[str, str] = {"gzip": ".gz", "zstd": ".zst", "xz": ".xz", "lz4": ".lz4", "none": ""}
+CODEC_DEFAULT_LEVELS: dict[str, int] = {"gzip": 6, "zstd": 3, "xz": 6, "lz4": 0}
+CODEC_MODULES: dict[str, str] = {"zstd": "zstandard", "lz4": "lz4.frame"}
 
 #
 ## Core Logging Setup
@@ -73,17 +82,40 @@ def shell_exec(command, description):
 
         return False
 
-def gzip_compression(source_path):
-    compressed_path = str(source_path) + ".gz"
+def open_compressed(path, mode='wb'):
+    level = COMPRESSION_LEVEL if COMPRESSION_LEVEL is not None else CODEC_DEFAULT_LEVELS.get(COMPRESSION)
+
+    if COMPRESSION == "gzip":
+        return gzip.open(path, mode, compresslevel=level)
+    elif COMPRESSION == "xz":
+        return lzma.open(path, mode, preset=level)
+    elif COMPRESSION == "zstd":
+        import zstandard
+        return zstandard.open(path, mode, cctx=zstandard.ZstdCompressor(level=level, threads=COMPRESSION_THREADS or -1))
+    elif COMPRESSION == "lz4":
+        import lz4.frame
+        return lz4.frame.open(path, mode, compression_level=level)
+    elif COMPRESSION == "none":
+        return open(path, mode)
+    else:
+        raise ValueError(f"Unknown compression codec: {COMPRESSION}")
+
+def compress_file(source_path):
+    if COMPRESSION == "none":
+        return str(source_path)
+
+    compressed_path = str(source_path) + CODEC_EXTENSIONS[COMPRESSION]
 
-    with open(source_path, 'rb') as f_in, gzip.open(compressed_path, 'wb') as f_out:
-        shutil.copyfileobj(f_in, f_out)
+    with open(source_path, 'rb') as f_in, open_compressed(compressed_path, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out, 1024 * 1024)
     os.remove(source_path)
 
     return compressed_path
 
 def rotate_backups(backup_dir, hostname):
-    backups = sorted(backup_dir.glob(f"{hostname}_*.sql.gz"), key=os.path.getmtime, reverse=True)
+    # Dumps of every codec are rotated, backups made before COMPRESSION was changed would otherwise never be deleted
+    suffixes = tuple(f".sql{extension}" for extension in CODEC_EXTENSIONS.values())
+    backups = sorted((path for path in backup_dir.glob(f"{hostname}_*.sql*") if path.name.endswith(suffixes)), key=os.path.getmtime, reverse=True)
 
     for old_backup in backups[MAX_BACKUPS:]:
         try:
@@ -101,6 +133,19 @@ def main():
     dump_file = BACKUP_DIR / f"{hostname}_{date_str}.sql"
     os.makedirs(BACKUP_DIR, exist_ok=True)
 
+    if COMPRESSION not in CODEC_EXTENSIONS:
+        logging.error(f"Unknown COMPRESSION codec: {COMPRESSION}. Aborting backup.")
+        return 1
+
+    # zstd and lz4 need optional python packages, a missing one has to fail before anything is dumped
+    if COMPRESSION in CODEC_MODULES:
+        try:
+            importlib.import_module(CODEC_MODULES[COMPRESSION])
+        except ImportError as e:
+            logging.error(f"COMPRESSION codec {COMPRESSION} is not available: {e}. Aborting backup.")
+            notify_slack(f"MariaDB backup error: python package for {COMPRESSION} compression is missing on {hostname}")
+            return 1
+
     # Run mariadb-check
     check_cmd = "mariadb-check --defaults-file=~/.my.cnf --all-databases"
     if not shell_exec(check_cmd, "mariadb-check"):
@@ -126,7 +171,7 @@ def main():
         return 1
 
     # Compress the backup
-    compressed_path = gzip_compression(dump_file)
+    compressed_path = compress_file(dump_file)
     logging.info(f"Compressed backup to: {compressed_path}")
 
     # Rotate backups
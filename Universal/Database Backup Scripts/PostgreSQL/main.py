@@ -10,13 +10,20 @@
 ## Imports
 #
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 import subprocess
+import importlib
 import requests
 import logging
 import socket
+import tempfile
 import shutil
+import sys
+import time
+import re
 import gzip
+import lzma
 import os
 
 #
@@ -31,6 +38,20 @@ BACKUP_GLOBALS: bool = True  # Set to True to backup globals, False to skip
 PG_HOST: str = "localhost"  # PostgreSQL host, change if needed
 PG_USER: str = "postgres"  # PostgreSQL user, change if needed
 # The reset MUST BE SET in the .pgpass file for the user running this script
+COMPRESSION: str = "gzip"  # "gzip", "zstd", "xz", "lz4" or "none" (zstd/lz4 require the zstandard/lz4 python packages)
+COMPRESSION_LEVEL: int | None = None  # None uses the codec default (gzip: 6, zstd: 3, xz: 6, lz4: 0)
+COMPRESSION_THREADS: int = 0  # zstd worker threads, 0 uses all CPU cores
+STREAM_DUMPS: bool = True  # Stream pg_dump output straight into the compressed file (no intermediate .sql file)
+STREAM_CHUNK_SIZE: int = 1024 * 1024  # Bytes read from pg_dump per iteration in streaming mode
+PARALLEL_DUMPS: int = 1  # Number of pg_dump processes run at once, >1 writes each database to its own file
+BACKUP_FORMAT: str = "plain"  # "plain" (compressed SQL), "directory" (pg_dump -Fd) or "custom" (pg_dump -Fc)
+DUMP_JOBS: int = 4  # Parallel jobs per database in "directory" format (pg_dump -j)
+DUMP_COMPRESSION: int = 6  # Compression level of "directory"/"custom" archives (pg_dump -Z)
+VERIFY_ARCHIVES: bool = True  # Check every "directory"/"custom" archive with pg_restore --list
+
+CODEC_EXTENSIONS: dict[str, str] = {"gzip": ".gz", "zstd": ".zst", "xz": ".xz", "lz4": ".lz4", "none": ""}
+CODEC_DEFAULT_LEVELS: dict[str, int] = {"gzip": 6, "zstd": 3, "xz": 6, "lz4": 0}
+CODEC_MODULES: dict[str, str] = {"zstd": "zstandard", "lz4": "lz4.frame"}
 
 #
 ## Core Logging Setup
@@ -74,29 +95,115 @@ def shell_exec(command, description):
         notify_slack(f"PostgreSQL backup error: {description} failed on {socket.gethostname()}")
         return False
 
-def gzip_compression(source_path):
-    compressed_path = str(source_path) + ".gz"
+def open_compressed(path, mode='wb'):
+    level = COMPRESSION_LEVEL if COMPRESSION_LEVEL is not None else CODEC_DEFAULT_LEVELS.get(COMPRESSION)
+
+    if COMPRESSION == "gzip":
+        return gzip.open(path, mode, compresslevel=level)
+    elif COMPRESSION == "xz":
+        return lzma.open(path, mode, preset=level)
+    elif COMPRESSION == "zstd":
+        import zstandard
+        return zstandard.open(path, mode, cctx=zstandard.ZstdCompressor(level=level, threads=COMPRESSION_THREADS or -1))
+    elif COMPRESSION == "lz4":
+        import lz4.frame
+        return lz4.frame.open(path, mode, compression_level=level)
+    elif COMPRESSION == "none":
+        return open(path, mode)
+    else:
+        raise ValueError(f"Unknown compression codec: {COMPRESSION}")
+
+def compress_file(source_path):
+    if COMPRESSION == "none":
+        return str(source_path)
+
+    compressed_path = str(source_path) + CODEC_EXTENSIONS[COMPRESSION]
 
-    with open(source_path, 'rb') as f_in, gzip.open(compressed_path, 'wb') as f_out:
-        shutil.copyfileobj(f_in, f_out)
+    with open(source_path, 'rb') as f_in, open_compressed(compressed_path, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out, 1024 * 1024)
     os.remove(source_path)
 
     return compressed_path
 
-def rotate_backups(backup_dir, hostname):
-    logging.info("Rotating PSQL backups.")
-    db_backups = sorted(
-        backup_dir.glob(f"{hostname}_*.sql.gz"),
-        key=os.path.getmtime,
-        reverse=True
-    )
+def stream_dump(command, output_path, description, notify=True):
+    logging.info(f"Streaming: {description}")
+    written = 0
 
-    for old_backup in db_backups[MAX_BACKUPS:]:
+    # stderr goes to a temporary file, so a chatty pg_dump can never block on a full pipe
+    with tempfile.TemporaryFile() as errors:
         try:
-            old_backup.unlink()
-            logging.info(f"Deleted old DB backup: {old_backup}")
-        except Exception as e:
-            logging.error(f"Failed to delete old DB backup {old_backup}: {e}")
+            with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=errors) as proc, open_compressed(output_path, 'ab') as f_out:
+                while chunk := proc.stdout.read(STREAM_CHUNK_SIZE):
+                    f_out.write(chunk)
+                    written += len(chunk)
+        except OSError as e:
+            logging.error(f"{description} failed: {e}")
+            if notify:
+                notify_slack(f"PostgreSQL backup error: {description} failed on {socket.gethostname()}")
+            return False
+
+        if proc.returncode != 0:
+            errors.seek(0)
+            logging.error(f"{description} failed:\n{errors.read().decode()}")
+            if notify:
+                notify_slack(f"PostgreSQL backup error: {description} failed on {socket.gethostname()}")
+            return False
+
+    if written == 0:
+        logging.error(f"{description} produced no output.")
+        if notify:
+            notify_slack(f"PostgreSQL backup error: {description} produced no output on {socket.gethostname()}")
+        return False
+
+    logging.info(f"Finished {description} ({written} bytes streamed)")
+    return True
+
+def remove_artifact(path):
+    if path.is_dir():
+        shutil.rmtree(path)
+    else:
+        path.unlink(missing_ok=True)
+
+def archive_dump(db, output_path, notify=True):
+    logging.info(f"Dumping database {db} to {BACKUP_FORMAT} archive")
+    cmd = ["pg_dump", "-h", PG_HOST, "-U", PG_USER, f"-F{BACKUP_FORMAT[0]}", "-Z", str(DUMP_COMPRESSION), "-f", str(output_path)]
+    if BACKUP_FORMAT == "directory":
+        cmd += ["-j", str(DUMP_JOBS)]
+    cmd.append(db)
+
+    try:
+        subprocess.run(cmd, check=True, capture_output=True)
+        if VERIFY_ARCHIVES:
+            subprocess.run(["pg_restore", "--list", str(output_path)], check=True, capture_output=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        stderr = getattr(e, 'stderr', None)
+        logging.error(f"{BACKUP_FORMAT} dump of database {db} failed:\n{stderr.decode() if stderr else e}")
+        if notify:
+            notify_slack(f"PostgreSQL backup error: {BACKUP_FORMAT} dump of {db} failed on {socket.gethostname()}")
+        return False
+
+    return True
+
+def rotate_backups(backup_dir, hostname):
+    # Group artifacts by the date of the run that created them, one run may produce several files
+    db_backups = {}
+    globals_backups = {}
+    for artifact in backup_dir.glob(f"{hostname}_*"):
+        match = re.match(rf"{re.escape(hostname)}_(\d{{2}}-\d{{2}}-\d{{4}})(_globals)?", artifact.name)
+        if not match:
+            continue
+
+        runs = globals_backups if match.group(2) else db_backups
+        runs.setdefault(datetime.strptime(match.group(1), '%d-%m-%Y'), []).append(artifact)
+
+    logging.info("Rotating PSQL backups.")
+    for run_date in sorted(db_backups, reverse=True)[MAX_BACKUPS:]:
+        for old_backup in db_backups[run_date]:
+            try:
+                remove_artifact(old_backup)
+                logging.info(f"Deleted old DB backup: {old_backup}")
+            except Exception as e:
+                logging.error(f"Failed to delete old DB backup {old_backup}: {e}")
 
     if not BACKUP_GLOBALS:
         logging.info("Skipping globals backup rotation as per configuration.")
@@ -104,19 +211,127 @@ def rotate_backups(backup_dir, hostname):
     else:
         logging.info("Rotating globals backups.")
 
-        globals_backups = sorted(
-            backup_dir.glob(f"{hostname}_*_globals.sql.gz"),
-            key=os.path.getmtime,
-            reverse=True
-        )
+        for run_date in sorted(globals_backups, reverse=True)[MAX_BACKUPS:]:
+            for old_backup in globals_backups[run_date]:
+                try:
+                    old_backup.unlink()
+                    logging.info(f"Deleted old globals backup: {old_backup}")
+                except Exception as e:
+                    logging.error(f"Failed to delete old globals backup {old_backup}: {e}")
+
+def list_databases():
+    cmd = ["psql", "-h", PG_HOST, "-U", PG_USER, "-d", "postgres", "-At", "-c",
+           "SELECT datname FROM pg_database WHERE datallowconn AND NOT datistemplate ORDER BY datname"]
+
+    try:
+        result = subprocess.run(cmd, check=True, capture_output=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        stderr = getattr(e, 'stderr', None)
+        logging.error(f"Listing databases failed:\n{stderr.decode() if stderr else e}")
+        notify_slack(f"PostgreSQL backup error: listing databases failed on {socket.gethostname()}")
+        return None
+
+    return result.stdout.decode().split()
+
+def dump_database(db, output_path):
+    start = time.monotonic()
+    if BACKUP_FORMAT == "plain":
+        cmd = ["pg_dump", "-h", PG_HOST, "-U", PG_USER, db]
+        # Only parallel_dump reports failed workers, with one notification for all of them
+        success = stream_dump(cmd, output_path, f"pg_dump of database {db}", notify=False)
+    else:
+        success = archive_dump(db, output_path, notify=False)
+
+    return success, time.monotonic() - start
+
+def parallel_dump(hostname, date_str):
+    databases = DATABASES or list_databases()
+    if not databases:
+        logging.error("No databases found to back up.")
+        return False
+
+    suffix = {"plain": f".sql{CODEC_EXTENSIONS[COMPRESSION]}", "directory": ".dir", "custom": ".dump"}[BACKUP_FORMAT]
+    logging.info(f"Backing up {len(databases)} databases using {PARALLEL_DUMPS} workers ({BACKUP_FORMAT} format).")
+    timings = {}
+    failed = []
+
+    with ThreadPoolExecutor(max_workers=PARALLEL_DUMPS) as pool:
+        futures = {}
+        for db in databases:
+            # pg_dump -Fd refuses to write into an existing directory
+            output_path = BACKUP_DIR / f"{hostname}_{date_str}_db-{db}{suffix}"
+            remove_artifact(output_path)
+            futures[pool.submit(dump_database, db, output_path)] = (db, output_path)
 
-        for old_backup in globals_backups[MAX_BACKUPS:]:
+        for future in as_completed(futures):
+            db, output_path = futures[future]
             try:
-                old_backup.unlink()
-                logging.info(f"Deleted old globals backup: {old_backup}")
+                success, elapsed = future.result()
             except Exception as e:
-                logging.error(f"Failed to delete old globals backup {old_backup}: {e}")
+                # An exception in a worker (e.g. a full disk while compressing) only fails its own database
+                logging.error(f"Backup of database {db} failed: {e}")
+                success, elapsed = False, 0.0
+            timings[db] = elapsed
+
+            if success:
+                logging.info(f"Finished backup of database {db} in {elapsed:.1f}s")
+            else:
+                failed.append(db)
+                remove_artifact(output_path)
+
+    for db, elapsed in sorted(timings.items(), key=lambda item: item[1], reverse=True):
+        logging.info(f"Timing: {db} - {elapsed:.1f}s{' (FAILED)' if db in failed else ''}")
+
+    if failed:
+        logging.error(f"Backup failed for databases: {', '.join(failed)}")
+        notify_slack(f"PostgreSQL backup error: {len(failed)} of {len(databases)} database dumps failed on {hostname} ({', '.join(failed)})")
+        return False
+
+    return True
+
+def stream_backup(hostname, date_str, dump_file, globals_dump_file):
+    compressed_path = Path(f"{dump_file}{CODEC_EXTENSIONS[COMPRESSION]}")
+    compressed_globals_path = Path(f"{globals_dump_file}{CODEC_EXTENSIONS[COMPRESSION]}")
+
+    # Stale files from an earlier run on the same day would otherwise get appended to
+    for path in (compressed_path, compressed_globals_path):
+        path.unlink(missing_ok=True)
+
+    if PARALLEL_DUMPS > 1 or BACKUP_FORMAT != "plain":
+        if not parallel_dump(hostname, date_str):
+            return 1
+    elif DATABASES:
+        # Each pg_dump is appended as a new compressed frame, decompressing restores them as one concatenated file
+        for db in DATABASES:
+            cmd = ["pg_dump", "-h", PG_HOST, "-U", PG_USER, db]
+            if not stream_dump(cmd, compressed_path, f"pg_dump of database {db}"):
+                compressed_path.unlink(missing_ok=True)
+                return 1
+    else:
+        cmd = ["pg_dumpall", "-h", PG_HOST, "-U", PG_USER]
+        if not stream_dump(cmd, compressed_path, "pg_dumpall"):
+            compressed_path.unlink(missing_ok=True)
+            return 1
+
+    if compressed_path.exists():
+        logging.info(f"Compressed backup to: {compressed_path}")
+
+    if not BACKUP_GLOBALS:
+        logging.info("Skipping globals backup as per configuration.")
+    else:
+        logging.info("Backing up PostgreSQL globals.")
+
+        cmd = ["pg_dumpall", "-h", PG_HOST, "-U", PG_USER, "--globals-only"]
+        if not stream_dump(cmd, compressed_globals_path, "pg_dumpall --globals-only"):
+            compressed_globals_path.unlink(missing_ok=True)
+            return 1
+        logging.info(f"Compressed globals backup to: {compressed_globals_path}")
 
+    rotate_backups(BACKUP_DIR, hostname)
+    logging.info("Backup rotation completed successfully.")
+
+    logging.info("Backup process completed successfully.")
+    return 0
 
 #
 ## Script Start point
@@ -128,11 +343,32 @@ def main():
     globals_dump_file = BACKUP_DIR / f"{hostname}_{date_str}_globals.sql"
     os.makedirs(BACKUP_DIR, exist_ok=True)
 
+    if COMPRESSION not in CODEC_EXTENSIONS:
+        logging.error(f"Unknown COMPRESSION codec: {COMPRESSION}. Aborting backup.")
+        return 1
+
+    # zstd and lz4 need optional python packages, a missing one has to fail before anything is dumped
+    if COMPRESSION in CODEC_MODULES:
+        try:
+            importlib.import_module(CODEC_MODULES[COMPRESSION])
+        except ImportError as e:
+            logging.error(f"COMPRESSION codec {COMPRESSION} is not available: {e}. Aborting backup.")
+            notify_slack(f"PostgreSQL backup error: python package for {COMPRESSION} compression is missing on {hostname}")
+            return 1
+
     # Run pg_isready (no host/port, uses default env and pgpass)
     if not shell_exec(f"pg_isready -h {PG_HOST}", "PostgreSQL readiness check"):
         logging.error("PostgreSQL is not ready. Aborting backup.")
         return 1
 
+    if BACKUP_FORMAT not in ("plain", "directory", "custom"):
+        logging.error(f"Unknown BACKUP_FORMAT: {BACKUP_FORMAT}. Aborting backup.")
+        return 1
+
+    # Parallel and archive format dumps are always streamed, every worker writes its own file
+    if STREAM_DUMPS or PARALLEL_DUMPS > 1 or BACKUP_FORMAT != "plain":
+        return stream_backup(hostname, date_str, dump_file, globals_dump_file)
+
     if DATABASES:
         # Dump each database individually and concatenate output to single file
         with open(dump_file, 'wb') as outfile:
@@ -180,18 +416,20 @@ def main():
         return 1
 
     # Compress the backup
-    compressed_path = gzip_compression(dump_file)
+    compressed_path = compress_file(dump_file)
     logging.info(f"Compressed backup to: {compressed_path}")
 
     # Compress globals dump
-    compressed_globals_path = gzip_compression(globals_dump_file)
-    logging.info(f"Compressed globals backup to: {compressed_globals_path}")
+    if globals_dump_file:
+        compressed_globals_path = compress_file(globals_dump_file)
+        logging.info(f"Compressed globals backup to: {compressed_globals_path}")
 
     # Rotate backups
     rotate_backups(BACKUP_DIR, hostname)
     logging.info("Backup rotation completed successfully.")
 
     logging.info("Backup process completed successfully.")
+    return 0
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,183 @@
+#!/usr/bin/python3
+
+#
+## Script Name: Backup Compression Benchmark
+## Author:      unkn0wnAPI [https://github.com/unkn0wnAPI]
+## Information: Measures the codecs supported by the database backup scripts on a sample (or synthesized) SQL dump
+#
+
+#
+## Imports
+#
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+import importlib.util
+import tempfile
+import resource
+import argparse
+import random
+import json
+import time
+import gzip
+import lzma
+import sys
+import os
+
+#
+## Global Variables
+#
+CHUNK_SIZE: int = 1024 * 1024
+CODEC_EXTENSIONS: dict[str, str] = {"gzip": ".gz", "zstd": ".zst", "xz": ".xz", "lz4": ".lz4", "none": ""}
+CODEC_MODULES: dict[str, str] = {"zstd": "zstandard", "lz4": "lz4"}
+BENCHMARK_LEVELS: dict[str, list[int]] = {"gzip": [1, 6, 9], "zstd": [1, 3, 9, 19], "xz": [1, 6], "lz4": [0, 9], "none": [0]}
+
+SYNTH_TABLES: list[str] = ["users", "orders", "invoices", "audit_log", "sessions"]
+SYNTH_WORDS: list[str] = ["alpha", "bravo", "charlie", "delta", "echo", "foxtrot", "golf", "hotel", "india", "juliett",
+                          "kilo", "lima", "mike", "november", "oscar", "papa", "quebec", "romeo", "sierra", "tango"]
+
+#
+## Functions
+#
+def argumentParser():
+    argParser = argparse.ArgumentParser(description='Benchmark the compression codecs used by the database backup scripts', epilog="Written by unkn0wnAPI, part of sysadmin-scripts [https://github.com/unkn0wnapi/sysadmin-scripts]")
+    argParser.add_argument('--input', '-i', action='store', dest='input', default=None, help='Uncompressed sample dump used for the benchmark [defaults to a synthesized SQL dump]')
+    argParser.add_argument('--size', '-s', action='store', dest='size', type=int, default=256, help='Size of the synthesized SQL dump in MB [defaults to 256]')
+    argParser.add_argument('--codecs', '-c', action='store', dest='codecs', default=','.join(CODEC_EXTENSIONS), help='Codecs to benchmark (Delimiter: ",") [defaults to all]')
+    argParser.add_argument('--levels', '-l', action='store', dest='levels', default='', help='Compression levels used for every codec (Delimiter: ",") [defaults to a per-codec set]')
+    argParser.add_argument('--threads', '-t', action='store', dest='threads', type=int, default=0, help='Number of zstd worker threads, 0 uses all CPU cores [defaults to 0]')
+    argParser.add_argument('--workdir', '-w', action='store', dest='workdir', default=None, help='Directory used for temporary files, use the backup disk for realistic numbers [defaults to system temp]')
+    argParser.add_argument('--json', action='store_true', dest='json', help='Print results as JSON instead of a table')
+    return argParser.parse_args()
+
+def synthesize_dump(path: Path, size_mb: int):
+    # pg_dump style COPY blocks: repetitive structure with random values, compresses like a real dump
+    rng = random.Random(1337)
+    target = size_mb * 1024 * 1024
+    written = 0
+    row_id = 0
+
+    with open(path, 'w') as f_out:
+        while written < target:
+            table = rng.choice(SYNTH_TABLES)
+            block = [f"COPY public.{table} (id, name, email, amount, created_at, note) FROM stdin;\n"]
+            for _ in range(1000):
+                row_id += 1
+                name = f"{rng.choice(SYNTH_WORDS)}_{rng.choice(SYNTH_WORDS)}"
+                note = ' '.join(rng.choices(SYNTH_WORDS, k=rng.randint(0, 8))) or r"\N"
+                block.append(f"{row_id}\t{name}\t{name}@example.com\t{rng.randint(0, 999999) / 100:.2f}\t"
+                             f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d} {rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d}\t"
+                             f"{note}\n")
+            block.append("\\.\n\n")
+            chunk = ''.join(block)
+            f_out.write(chunk)
+            written += len(chunk)
+
+def open_codec(codec: str, path: Path, mode: str, level: int = 0, threads: int = 0):
+    if codec == "gzip":
+        return gzip.open(path, mode, compresslevel=level) if 'w' in mode else gzip.open(path, mode)
+    elif codec == "xz":
+        return lzma.open(path, mode, preset=level) if 'w' in mode else lzma.open(path, mode)
+    elif codec == "zstd":
+        import zstandard
+        if 'w' in mode:
+            return zstandard.open(path, mode, cctx=zstandard.ZstdCompressor(level=level, threads=threads or -1))
+        return zstandard.open(path, mode)
+    elif codec == "lz4":
+        import lz4.frame
+        return lz4.frame.open(path, mode, compression_level=level) if 'w' in mode else lz4.frame.open(path, mode)
+    else:
+        return open(path, mode)
+
+def run_trial(codec: str, level: int, threads: int, source: str, workdir: str) -> dict:
+    # Executed in a fresh process, so ru_maxrss only reflects this trial
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    source_size = os.path.getsize(source)
+    fd, output = tempfile.mkstemp(suffix=CODEC_EXTENSIONS[codec], dir=workdir)
+    os.close(fd)
+
+    try:
+        start = time.perf_counter()
+        with open(source, 'rb') as f_in, open_codec(codec, Path(output), 'wb', level, threads) as f_out:
+            while chunk := f_in.read(CHUNK_SIZE):
+                f_out.write(chunk)
+        compress_time = time.perf_counter() - start
+        compressed_size = os.path.getsize(output)
+
+        start = time.perf_counter()
+        with open_codec(codec, Path(output), 'rb') as f_in:
+            while f_in.read(CHUNK_SIZE):
+                pass
+        decompress_time = time.perf_counter() - start
+    finally:
+        os.remove(output)
+
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    source_mb = source_size / 1024 / 1024
+
+    return {
+        "codec": codec,
+        "level": level,
+        "input_mb": round(source_mb, 2),
+        "output_mb": round(compressed_size / 1024 / 1024, 2),
+        "ratio": round(source_size / max(compressed_size, 1), 2),
+        "compress_mb_s": round(source_mb / max(compress_time, 1e-9), 1),
+        "decompress_mb_s": round(source_mb / max(decompress_time, 1e-9), 1),
+        "peak_memory_mb": round((peak_kb - baseline_kb) / 1024, 1),
+    }
+
+def print_table(results: list[dict]):
+    header = f"{'CODEC':<6} {'LEVEL':>5} {'RATIO':>7} {'COMP MB/s':>10} {'DECOMP MB/s':>12} {'PEAK MEM MB':>12} {'OUTPUT MB':>10}"
+    print(header)
+    print('-' * len(header))
+    for result in results:
+        print(f"{result['codec']:<6} {result['level']:>5} {result['ratio']:>7} {result['compress_mb_s']:>10} "
+              f"{result['decompress_mb_s']:>12} {result['peak_memory_mb']:>12} {result['output_mb']:>10}")
+
+#
+## Script Start point
+#
+def main():
+    args = argumentParser()
+    codecs = [codec.strip() for codec in args.codecs.split(',') if codec.strip()]
+    levels = [int(level) for level in args.levels.split(',') if level.strip()]
+
+    for codec in codecs:
+        if codec not in CODEC_EXTENSIONS:
+            print(f"[ERROR] Unknown codec: {codec}")
+            return 1
+
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        if args.input:
+            source = Path(args.input)
+            if not source.is_file():
+                print(f"[ERROR] Sample dump {source} does not exist")
+                return 1
+        else:
+            source = Path(workdir) / "synthetic_dump.sql"
+            if not args.json:
+                print(f"[INFO] Synthesizing {args.size} MB SQL dump", flush=True)
+            synthesize_dump(source, args.size)
+
+        results = []
+        for codec in codecs:
+            if codec in CODEC_MODULES and importlib.util.find_spec(CODEC_MODULES[codec]) is None:
+                print(f"[WARN] Skipping {codec}, python package '{CODEC_MODULES[codec]}' is not installed", file=sys.stderr)
+                continue
+
+            for level in (levels if levels and codec != "none" else BENCHMARK_LEVELS[codec]):
+                if not args.json:
+                    print(f"[INFO] Benchmarking {codec} level {level}", flush=True)
+
+                with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+                    results.append(pool.submit(run_trial, codec, level, args.threads, str(source), workdir).result())
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print()
+        print_table(results)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+
+#
+## Script Name: Portainer Updater Benchmark
+## Author:      unkn0wnAPI [https://github.com/unkn0wnAPI]
+## Information: Measures update runs of the Portainer Updater against the local mock Portainer API
+#
+
+#
+## Imports
+#
+from urllib.request import Request, urlopen
+from pathlib import Path
+import subprocess, threading, tempfile, argparse, json, time, sys
+
+from mock_portainer import create_server
+
+#
+## Init configuration variable
+#
+UPDATER = Path(__file__).resolve().parent / "main.py"
+API_KEY = "benchmark"
+
+#
+## Core Functions
+#
+def init_arg_parse():
+    args = argparse.ArgumentParser(description='Measures update runs of the Portainer Updater against the local mock Portainer API', epilog="Written by unkn0wnAPI, part of sysadmin-scripts [https://github.com/unkn0wnapi/sysadmin-scripts]")
+    args.add_argument('--endpoints', '-e', action='store', type=int, dest='endpoints', default=5, help='Number of generated endpoints [defaults to 5]')
+    args.add_argument('--stacks', '-s', action='store', type=int, dest='stacks', default=20, help='Number of generated stacks per endpoint [defaults to 20]')
+    args.add_argument('--latency', '-l', action='store', type=float, dest='latency', default=10, help='Latency of every API request in ms [defaults to 10]')
+    args.add_argument('--redeploy-latency', '-rl', action='store', type=float, dest='redeploy_latency', default=200, help='Additional latency of a stack redeploy in ms [defaults to 200]')
+    args.add_argument('--failure-rate', '-f', action='store', type=float, dest='failure_rate', default=0.0, help='Share of redeploys that fail with HTTP 500 (0.0 - 1.0) [defaults to 0.0]')
+    args.add_argument('--workers', '-w', action='store', type=int, dest='workers', default=8, help='Workers used by the concurrent and rolling modes [defaults to 8]')
+    args.add_argument('--endpoint-workers', '-ew', action='store', type=int, dest='endpoint_workers', default=2, help='Per endpoint workers used by the concurrent and rolling modes [defaults to 2]')
+    args.add_argument('--modes', '-m', action='store', dest='modes', default='serial,concurrent,rolling', help='Update modes to benchmark (Delimiter: ",") [defaults to serial,concurrent,rolling]')
+    args.add_argument('--port', '-p', action='store', type=int, dest='port', default=9010, help='Port used by the mock Portainer API [defaults to 9010]')
+    args.add_argument('--json', action='store_true', dest='json', help='Print results as JSON instead of a table')
+
+    return args.parse_args()
+
+def mode_arguments(mode: str, ARGS) -> list:
+    if mode == "serial":
+        return []
+    elif mode == "concurrent":
+        return ["--workers", str(ARGS.workers), "--endpoint-workers", str(ARGS.endpoint_workers)]
+    elif mode == "rolling":
+        # Failed stacks are tolerated, otherwise injected failures would halt the run and distort the timing
+        return ["--rolling", "--batch-size", str(ARGS.workers * 2), "--max-unavailable", str(ARGS.workers), "--endpoint-workers", str(ARGS.endpoint_workers), "--max-failures", str(ARGS.endpoints * ARGS.stacks), "--health-timeout", "10"]
+    return None
+
+def mock_call(port: int, method: str, path: str) -> dict:
+    with urlopen(Request(f"http://127.0.0.1:{port}{path}", method=method)) as response:
+        return json.loads(response.read())
+
+def run_updater(mode: str, ARGS) -> dict:
+    # Without retries every injected failure is one redeploy request, so the redeploy count matches the stack count
+    mock_call(ARGS.port, "POST", "/mock/reset")
+    command = [sys.executable, str(UPDATER), "--no-env", "--endpoint", f"http://127.0.0.1:{ARGS.port}", "--api-key", API_KEY,
+               "--inventory-cache-ttl", "0", "--retries", "0", *mode_arguments(mode, ARGS)]
+
+    # Runs in an empty directory, so cache files of the updater don't influence (or survive) the benchmark
+    with tempfile.TemporaryDirectory() as workdir:
+        start = time.perf_counter()
+        result = subprocess.run(command, cwd=workdir, capture_output=True, text=True)
+        elapsed = time.perf_counter() - start
+
+    stats = mock_call(ARGS.port, "GET", "/mock/stats")
+    redeploys = sum(count for request, count in stats.get("requests").items() if request.startswith("stack_redeploy"))
+    stacks = ARGS.endpoints * ARGS.stacks
+
+    return {
+        "mode": mode,
+        "exit_code": result.returncode,
+        "seconds": round(elapsed, 2),
+        "stacks_per_second": round(stacks / max(elapsed, 1e-9), 2),
+        "requests": stats.get("total_requests"),
+        "stacks": stacks,
+        "redeploys": redeploys,
+        "redeploy_errors": stats.get("requests").get("stack_redeploy 500", 0),
+        "peak_concurrent_redeploys": stats.get("peak_concurrent_redeploys"),
+        "requests_by_route": stats.get("requests"),
+    }
+
+def print_table(results: list):
+    header = f"{'MODE':<11} {'SECONDS':>8} {'STACKS/s':>9} {'REQUESTS':>9} {'STACKS':>7} {'REDEPLOYS':>10} {'HTTP 500':>9} {'PEAK PARALLEL':>14} {'EXIT':>5}"
+    print(header)
+    print('-' * len(header))
+    for result in results:
+        print(f"{result['mode']:<11} {result['seconds']:>8} {result['stacks_per_second']:>9} {result['requests']:>9} {result['stacks']:>7} {result['redeploys']:>10} "
+              f"{result['redeploy_errors']:>9} {result['peak_concurrent_redeploys']:>14} {result['exit_code']:>5}")
+
+#
+## Script Start point
+#
+def main():
+    ARGS = init_arg_parse()
+    modes = [mode.strip() for mode in ARGS.modes.split(',') if mode.strip()]
+    for mode in modes:
+        if mode_arguments(mode, ARGS) is None:
+            print(f"[ERR] Unknown mode: {mode}")
+            return 1
+
+    server = create_server("127.0.0.1", ARGS.port, ARGS.endpoints, ARGS.stacks, API_KEY, ARGS.latency / 1000, ARGS.redeploy_latency / 1000, ARGS.failure_rate)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    results = []
+    try:
+        for mode in modes:
+            if not ARGS.json:
+                print(f"[INF] Benchmarking {mode} mode [{ARGS.endpoints} endpoints x {ARGS.stacks} stacks]", flush=True)
+            results.append(run_updater(mode, ARGS))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    if ARGS.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print()
+        print_table(results)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
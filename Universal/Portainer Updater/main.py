@@ -9,7 +9,10 @@
 #
 ## Imports
 #
-import requests, argparse, json, urllib3
+import requests, argparse, json, urllib3, threading, time, os, re
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from colorama import Fore as F, Style as S
 from dotenv import dotenv_values, find_dotenv
 from datetime import datetime
@@ -18,11 +21,141 @@ from datetime import datetime
 ## Init configuration variable
 #
 CONFIGS = {}
-REQ_HEADERS = {}
+CLIENT = None
+TIMINGS = None
+
+REGISTRY_SESSION = requests.Session()
+DIGEST_CACHE = {}
+DIGEST_CACHE_LOCK = threading.Lock()
+RETRY_METHODS = frozenset({"GET", "HEAD"})
+INVENTORY_FIELDS = ("Id", "Name", "EndpointId")
+IMAGE_PATTERN = re.compile(r"^\s*image:\s*[\"']?([^\"'\s#]+)", re.MULTILINE)
+MANIFEST_TYPES = ", ".join([
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+])
 
 #
 ## Core Functions
 #
+def escape_label(value) -> str:
+    # Prometheus label values escape backslashes, double quotes and newlines, one unescaped name would make node_exporter reject the whole file
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class TimingReport:
+    # Collects request and stack timings, written as JSON lines (one event per line) and/or as a node_exporter textfile
+    def __init__(self, log_file: str = "", textfile: str = ""):
+        self.textfile = textfile
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = {}
+        self.stacks = []
+        self.log = open(log_file, 'a') if log_file else None
+
+    def emit(self, event: dict):
+        if self.log is not None:
+            with self.lock:
+                self.log.write(json.dumps(event) + "\n")
+
+    def record_request(self, method: str, path: str, status, seconds: float, size: int):
+        with self.lock:
+            total = self.requests.setdefault((method, str(status)), [0, 0.0, 0])
+            total[0] += 1
+            total[1] += seconds
+            total[2] += size
+        self.emit({ "event": "request", "time": round(time.time(), 3), "method": method, "path": path, "status": status, "seconds": round(seconds, 4), "bytes": size })
+
+    def record_stack(self, endpointName: str, stackName: str, status: dict):
+        self.stacks.append((endpointName, stackName, status))
+        self.emit({ "event": "stack", "time": round(time.time(), 3), "endpoint": endpointName, "stack": stackName, "stack_id": status.get('StackId'),
+                    "status": status.get('RedeployStatus'), "healthy": status.get('Healthy'), "seconds": { phase: round(seconds, 4) for phase, seconds in status.get('Timings', {}).items() } })
+
+    def close(self):
+        duration = time.time() - self.started
+        self.emit({ "event": "run", "time": round(time.time(), 3), "seconds": round(duration, 3), "stacks": len(self.stacks) })
+        if self.log is not None:
+            self.log.close()
+        if not self.textfile:
+            return
+
+        results = {}
+        lines = [
+            "# HELP portainer_updater_last_run_timestamp_seconds Time the last update run finished.",
+            "# TYPE portainer_updater_last_run_timestamp_seconds gauge",
+            f"portainer_updater_last_run_timestamp_seconds {time.time():.0f}",
+            "# HELP portainer_updater_run_duration_seconds Duration of the last update run.",
+            "# TYPE portainer_updater_run_duration_seconds gauge",
+            f"portainer_updater_run_duration_seconds {duration:.3f}",
+            "# HELP portainer_updater_stack_duration_seconds Duration of the update phases of every stack in the last run.",
+            "# TYPE portainer_updater_stack_duration_seconds gauge",
+        ]
+        for endpointName, stackName, status in self.stacks:
+            result = "updated" if status.get('RedeployStatus') == 200 and status.get('Healthy') is not False else str(status.get('RedeployStatus')) if status.get('RedeployStatus') in ("unchanged", "halted") else "failed"
+            results[result] = results.get(result, 0) + 1
+            for phase, seconds in status.get('Timings', {}).items():
+                lines.append(f'portainer_updater_stack_duration_seconds{{endpoint="{escape_label(endpointName)}",stack="{escape_label(stackName)}",phase="{phase}"}} {seconds:.3f}')
+
+        lines += ["# HELP portainer_updater_stacks Number of stacks by update result in the last run.", "# TYPE portainer_updater_stacks gauge"]
+        lines += [f'portainer_updater_stacks{{result="{result}"}} {count}' for result, count in sorted(results.items())]
+        families = [
+            ("portainer_updater_requests", "Number of Portainer API requests in the last run.", "{:d}"),
+            ("portainer_updater_request_duration_seconds", "Total duration of Portainer API requests in the last run.", "{:.3f}"),
+            ("portainer_updater_response_bytes", "Total size of Portainer API responses in the last run.", "{:d}"),
+        ]
+        for position, (name, description, value) in enumerate(families):
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} gauge"]
+            for (method, status), totals in sorted(self.requests.items()):
+                lines.append(f'{name}{{method="{method}",status="{status}"}} {value.format(totals[position])}')
+
+        # node_exporter may read the file at any time, it is replaced atomically
+        with open(f"{self.textfile}.tmp", 'w') as f_out:
+            f_out.write("\n".join(lines) + "\n")
+        os.replace(f"{self.textfile}.tmp", self.textfile)
+
+class PortainerClient:
+    # One pooled session for all API calls: connections are kept alive between requests (and shared by the update workers),
+    # connection errors and 5xx/429 responses of reads are retried with exponential backoff (backoff * 2^attempt seconds)
+    def __init__(self, base_url: str, api_key: str, verify_tls: bool = True, timeout: int = 300, retries: int = 3, backoff: float = 0.5, pool_size: int = 10, report: TimingReport = None):
+        self.base_url = base_url.rstrip('/')
+        self.verify_tls = verify_tls
+        self.timeout = (10, timeout)
+        self.report = report
+
+        # Read errors are not retried, a redeploy that timed out may still be running on the endpoint. Error responses are only retried
+        # for reads, a failed redeploy (PUT) or stop/start (POST) may have been applied partially and has to reach the caller
+        retry = Retry(total=retries, connect=retries, read=0, status=retries, backoff_factor=backoff,
+                      status_forcelist=(429, 500, 502, 503, 504), allowed_methods=RETRY_METHODS, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.headers.update({ "X-API-Key": api_key, 'Content-Type': 'application/json' })
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        started = time.monotonic()
+        try:
+            response = self.session.request(method, f"{self.base_url}{path}", verify=self.verify_tls, timeout=self.timeout, **kwargs)
+        except requests.RequestException:
+            if self.report is not None:
+                self.report.record_request(method, path, "error", time.monotonic() - started, 0)
+            raise
+
+        if self.report is not None:
+            self.report.record_request(method, path, response.status_code, time.monotonic() - started, len(response.content))
+        return response
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.request("POST", path, **kwargs)
+
+    def put(self, path: str, **kwargs) -> requests.Response:
+        return self.request("PUT", path, **kwargs)
+
 def pprint(severity: str, message: str):
     if severity == "INF":
         print(f"{F.LIGHTBLUE_EX}[INF] {message}{S.RESET_ALL}")
@@ -43,11 +176,29 @@ def init_arg_parse():
     args.add_argument('--skip-endpoints', '-se', action='store', default='', dest='skip_endpoints', help='List of endpoint names that will be excluded during updates (Delimiter: ",")')
     args.add_argument('--unsafe-tls', '-t', action='store_false', dest='unsafe_tls', help='Don\'t verify portainer TLS certificate')
     args.add_argument('--skip-check', '-sc', action='store_true', dest='skip_check', help='Skip initial connectivity check to the portainer endpoint')
+    args.add_argument('--workers', '-w', action='store', type=int, default=1, dest='workers', help='Maximum number of stacks updated at the same time (1 updates stacks one by one) [defaults to 1]')
+    args.add_argument('--endpoint-workers', '-ew', action='store', type=int, default=1, dest='endpoint_workers', help='Maximum number of stacks updated at the same time on a single endpoint [defaults to 1]')
+    args.add_argument('--timeout', '-to', action='store', type=int, default=300, dest='timeout', help='Seconds to wait for a Portainer API response (redeploys include image pulls) [defaults to 300]')
+    args.add_argument('--retries', '-r', action='store', type=int, default=3, dest='retries', help='Number of retries for connection errors and 5xx responses of read requests [defaults to 3]')
+    args.add_argument('--rolling', '-ro', action='store_true', dest='rolling', help='Update stacks in waves (canary first) without stopping them, halting on failures')
+    args.add_argument('--canary-size', '-cs', action='store', type=int, default=1, dest='canary_size', help='Number of stacks in the first (canary) wave of a rolling update [defaults to 1]')
+    args.add_argument('--batch-size', '-bs', action='store', type=int, default=10, dest='batch_size', help='Number of stacks in every following wave of a rolling update [defaults to 10]')
+    args.add_argument('--max-unavailable', '-mu', action='store', type=int, default=1, dest='max_unavailable', help='Maximum number of stacks redeploying or waiting for their health check at the same time [defaults to 1]')
+    args.add_argument('--max-failures', '-mf', action='store', type=int, default=0, dest='max_failures', help='Number of failed stacks tolerated before a rolling update halts [defaults to 0]')
+    args.add_argument('--health-timeout', '-ht', action='store', type=int, default=120, dest='health_timeout', help='Seconds to wait for the containers of a redeployed stack to become healthy [defaults to 120]')
+    args.add_argument('--timing-log', '-tl', action='store', default='', dest='timing_log', help='Append request and stack timings as JSON lines to this file')
+    args.add_argument('--metrics-textfile', '-mt', action='store', default='', dest='metrics_textfile', help='Write run metrics to this node_exporter textfile (*.prom)')
+    args.add_argument('--inventory-cache', '-ic', action='store', default='.inventory_cache.json', dest='inventory_cache', help='File used to cache the endpoint and stack list between runs [defaults to .inventory_cache.json]')
+    args.add_argument('--inventory-cache-ttl', '-it', action='store', type=int, default=300, dest='inventory_cache_ttl', help='Seconds the cached inventory is used without asking Portainer, 0 disables the cache [defaults to 300]')
+    args.add_argument('--refresh-inventory', '-ri', action='store_true', dest='refresh_inventory', help='Ignore a fresh inventory cache and fetch it from Portainer')
+    args.add_argument('--skip-unchanged', '-su', action='store_true', dest='skip_unchanged', help='Only stop and redeploy stacks whose running images differ from the registry')
+    args.add_argument('--digest-cache', '-dc', action='store', default='.digest_cache.json', dest='digest_cache', help='File used to cache registry digests between runs [defaults to .digest_cache.json]')
+    args.add_argument('--digest-cache-ttl', '-dt', action='store', type=int, default=3600, dest='digest_cache_ttl', help='Seconds a cached registry digest stays valid [defaults to 3600]')
     
     return args.parse_args()
 
 def load_configs():
-    global CONFIGS, REQ_HEADERS
+    global CONFIGS, CLIENT, TIMINGS
 
     ARGS = init_arg_parse()
     if ARGS.noenv == False:
@@ -68,12 +219,24 @@ def load_configs():
                 CONFIGS.update({"SKIP_CONNECTIVITY_CHECK": False})
             else:
                 CONFIGS.update({"SKIP_CONNECTIVITY_CHECK": True})
+
+            CONFIGS.update({"MAX_WORKERS": int(CONFIGS.get("MAX_WORKERS") or 1), "MAX_WORKERS_PER_ENDPOINT": int(CONFIGS.get("MAX_WORKERS_PER_ENDPOINT") or 1)})
+            CONFIGS.update({"REQUEST_TIMEOUT": int(CONFIGS.get("REQUEST_TIMEOUT") or 300), "REQUEST_RETRIES": int(CONFIGS.get("REQUEST_RETRIES") or 3)})
+            CONFIGS.update({"ROLLING_UPDATE": CONFIGS.get("ROLLING_UPDATE") == "True", "CANARY_SIZE": int(CONFIGS.get("CANARY_SIZE") or 1), "BATCH_SIZE": int(CONFIGS.get("BATCH_SIZE") or 10),
+                            "MAX_UNAVAILABLE": int(CONFIGS.get("MAX_UNAVAILABLE") or 1), "MAX_FAILURES": int(CONFIGS.get("MAX_FAILURES") or 0), "HEALTH_TIMEOUT": int(CONFIGS.get("HEALTH_TIMEOUT") or 120)})
+            CONFIGS.update({"TIMING_LOG": CONFIGS.get("TIMING_LOG") or "", "METRICS_TEXTFILE": CONFIGS.get("METRICS_TEXTFILE") or ""})
+            CONFIGS.update({"INVENTORY_CACHE_FILE": CONFIGS.get("INVENTORY_CACHE_FILE") or ".inventory_cache.json", "INVENTORY_CACHE_TTL": int(CONFIGS.get("INVENTORY_CACHE_TTL") or 300), "REFRESH_INVENTORY": ARGS.refresh_inventory})
+            CONFIGS.update({"SKIP_UNCHANGED": CONFIGS.get("SKIP_UNCHANGED") == "True", "DIGEST_CACHE_FILE": CONFIGS.get("DIGEST_CACHE_FILE") or ".digest_cache.json", "DIGEST_CACHE_TTL": int(CONFIGS.get("DIGEST_CACHE_TTL") or 3600)})
             
             pprint("ACT", f"Loaded script configuration from .env file")
     else:
         pprint("INF", "Variables from .env file won't be loaded, reading script arguments")
         
-        CONFIGS = { "PORTAINER_API_ENDPOINT": ARGS.endpoint, "PORTAINER_API_KEY": ARGS.key, "VERIFY_TLS_CERT": ARGS.unsafe_tls, "SKIP_CONNECTIVITY_CHECK": ARGS.skip_check, "SKIP_ENDPOINTS_LIST": ARGS.skip_endpoints }
+        CONFIGS = { "PORTAINER_API_ENDPOINT": ARGS.endpoint, "PORTAINER_API_KEY": ARGS.key, "VERIFY_TLS_CERT": ARGS.unsafe_tls, "SKIP_CONNECTIVITY_CHECK": ARGS.skip_check, "SKIP_ENDPOINTS_LIST": ARGS.skip_endpoints, "MAX_WORKERS": ARGS.workers, "MAX_WORKERS_PER_ENDPOINT": ARGS.endpoint_workers, "REQUEST_TIMEOUT": ARGS.timeout, "REQUEST_RETRIES": ARGS.retries,
+                    "ROLLING_UPDATE": ARGS.rolling, "CANARY_SIZE": ARGS.canary_size, "BATCH_SIZE": ARGS.batch_size, "MAX_UNAVAILABLE": ARGS.max_unavailable, "MAX_FAILURES": ARGS.max_failures, "HEALTH_TIMEOUT": ARGS.health_timeout,
+                    "TIMING_LOG": ARGS.timing_log, "METRICS_TEXTFILE": ARGS.metrics_textfile,
+                    "INVENTORY_CACHE_FILE": ARGS.inventory_cache, "INVENTORY_CACHE_TTL": ARGS.inventory_cache_ttl, "REFRESH_INVENTORY": ARGS.refresh_inventory,
+                    "SKIP_UNCHANGED": ARGS.skip_unchanged, "DIGEST_CACHE_FILE": ARGS.digest_cache, "DIGEST_CACHE_TTL": ARGS.digest_cache_ttl }
 
         if (CONFIGS.get("PORTAINER_API_ENDPOINT") == "" or CONFIGS.get("PORTAINER_API_KEY") == "" or CONFIGS.get("VERIFY_TLS_CERT") == ""):
             pprint("ERR", "Missing required variables, exiting")
@@ -83,15 +246,18 @@ def load_configs():
                 urllib3.disable_warnings()
             pprint("ACT", "Loaded script configuration from arguments")
     
-    REQ_HEADERS = { "X-API-Key": CONFIGS.get('PORTAINER_API_KEY'), 'Content-Type': 'application/json' }
+    TIMINGS = TimingReport(CONFIGS.get("TIMING_LOG"), CONFIGS.get("METRICS_TEXTFILE"))
+    CLIENT = PortainerClient(CONFIGS.get('PORTAINER_API_ENDPOINT'), CONFIGS.get('PORTAINER_API_KEY'), verify_tls=bool(CONFIGS.get("VERIFY_TLS_CERT")),
+                             timeout=CONFIGS.get("REQUEST_TIMEOUT"), retries=CONFIGS.get("REQUEST_RETRIES"), pool_size=max(10, CONFIGS.get("MAX_WORKERS"), CONFIGS.get("MAX_UNAVAILABLE")), report=TIMINGS)
+    REGISTRY_SESSION.mount('https://', HTTPAdapter(pool_maxsize=max(10, CONFIGS.get("MAX_WORKERS")), max_retries=Retry(total=CONFIGS.get("REQUEST_RETRIES"), backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504), allowed_methods=RETRY_METHODS, raise_on_status=False)))
 
 def check_portainer_availability():
-    global REQ_HEADERS, CONFIGS
+    global CLIENT, CONFIGS
 
     if CONFIGS.get('SKIP_CONNECTIVITY_CHECK') == False:
         try:
             pprint("INF", "Checking connectivity and access to portainer endpoint...")
-            check = requests.get(f"{CONFIGS.get('PORTAINER_API_ENDPOINT')}/motd", headers=REQ_HEADERS, verify=bool(CONFIGS.get("VERIFY_TLS_CERT")))
+            check = CLIENT.get("/motd")
                 
             if check.status_code == 200:
                 pprint("ACT", "Connection and authorization was successful")
@@ -105,59 +271,378 @@ def check_portainer_availability():
     else:
         pprint('WRN', "Skipping initial connectivity check")
 
+def get_cached_list(path: str, cache: dict) -> list:
+    # Conditional request when the cached response has an ETag, a 304 reuses the cached data
+    cached = cache.get('Responses', {}).get(path)
+    headers = { "If-None-Match": cached.get('ETag') } if cached and cached.get('ETag') else {}
+
+    listReq = CLIENT.get(path, headers=headers)
+    if listReq.status_code == 304 and cached:
+        return cached.get('Data')
+
+    # Only the fields the inventory needs are kept, the full /stacks response includes the stack Env (secrets)
+    listReq.raise_for_status()
+    listData = [{ field: item.get(field) for field in INVENTORY_FIELDS if field in item } for item in listReq.json()]
+    cache.setdefault('Responses', {})[path] = { "ETag": listReq.headers.get('ETag'), "Data": listData }
+    return listData
+
+def save_inventory_cache(cache: dict):
+    # Written to a private temp file (0600) and renamed, a crash never leaves a partial or world-readable cache
+    temp_file = f"{CONFIGS.get('INVENTORY_CACHE_FILE')}.tmp"
+    if os.path.exists(temp_file):
+        os.unlink(temp_file)
+    with os.fdopen(os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'w') as f_out:
+        json.dump(cache, f_out)
+    os.replace(temp_file, CONFIGS.get('INVENTORY_CACHE_FILE'))
+
 def get_instance_data() -> list:
-    global REQ_HEADERS
+    global CLIENT
     data = []
     endpoints = []
-    stacksList = []
+    stacksByEndpoint = {}
 
-    endpointReq = requests.get(f"{CONFIGS.get('PORTAINER_API_ENDPOINT')}/endpoints", headers=REQ_HEADERS, verify=bool(CONFIGS.get("VERIFY_TLS_CERT")))
-    for endpoint in endpointReq.json():
-        endpoints.append({ "EndpointId": endpoint.get('Id'), "EndpointName": endpoint.get('Name') }) 
+    try:
+        with open(CONFIGS.get('INVENTORY_CACHE_FILE'), 'r') as f_in:
+            cache = json.load(f_in)
+    except (OSError, ValueError):
+        cache = {}
+
+    # A fresh cache of the same Portainer instance is used without any request, a stale one is revalidated
+    responses = cache.get('Responses', {})
+    if (cache.get('PortainerEndpoint') == CONFIGS.get('PORTAINER_API_ENDPOINT') and not CONFIGS.get('REFRESH_INVENTORY')
+            and time.time() - cache.get('Fetched', 0) < CONFIGS.get('INVENTORY_CACHE_TTL') and '/endpoints' in responses and '/stacks' in responses):
+        pprint('INF', f"Using cached inventory from {datetime.fromtimestamp(cache.get('Fetched')).strftime('%H:%M:%S')}")
+        endpointsData, stacksData = responses['/endpoints'].get('Data'), responses['/stacks'].get('Data')
+    else:
+        if cache.get('PortainerEndpoint') != CONFIGS.get('PORTAINER_API_ENDPOINT'):
+            cache = {}
+        endpointsData = get_cached_list("/endpoints", cache)
+        stacksData = get_cached_list("/stacks", cache)
 
-    for endpoint in endpoints:
-        json_filter = {
-            'EndpointId': endpoint.get('EndpointId')
-        }
+        if CONFIGS.get('INVENTORY_CACHE_TTL') > 0:
+            cache.update({ "PortainerEndpoint": CONFIGS.get('PORTAINER_API_ENDPOINT'), "Fetched": time.time() })
+            save_inventory_cache(cache)
 
-        stacksReq = requests.get(f"{CONFIGS.get('PORTAINER_API_ENDPOINT')}/stacks?filters={json.dumps(json_filter)}", headers=REQ_HEADERS, verify=bool(CONFIGS.get("VERIFY_TLS_CERT")))
-        stacks = stacksReq.json()
+    for endpoint in endpointsData:
+        endpoints.append({ "EndpointId": endpoint.get('Id'), "EndpointName": endpoint.get('Name') }) 
 
-        for stack in stacks:
-            stacksList.append({ "StackName": stack.get('Name'), "StackId": stack.get('Id'), "EndpointId": json_filter.get('EndpointId') })
+    # All stacks are fetched with one request and indexed by their endpoint
+    for stack in stacksData:
+        stacksByEndpoint.setdefault(stack.get('EndpointId'), []).append({ "StackName": stack.get('Name'), "StackId": stack.get('Id'), "EndpointId": stack.get('EndpointId') })
 
     data.append(endpoints)
-    data.append(stacksList)
+    data.append(stacksByEndpoint)
     return data
 
+#
+## Image Digest Functions
+#
+def load_digest_cache():
+    global DIGEST_CACHE
+
+    try:
+        with open(CONFIGS.get('DIGEST_CACHE_FILE'), 'r') as f_in:
+            DIGEST_CACHE = json.load(f_in)
+    except (OSError, ValueError):
+        DIGEST_CACHE = {}
+
+def save_digest_cache():
+    temp_file = f"{CONFIGS.get('DIGEST_CACHE_FILE')}.tmp"
+    with DIGEST_CACHE_LOCK:
+        with open(temp_file, 'w') as f_out:
+            json.dump(DIGEST_CACHE, f_out)
+    os.replace(temp_file, CONFIGS.get('DIGEST_CACHE_FILE'))
+
+def parse_image_reference(image: str) -> tuple:
+    # "nginx" -> ("registry-1.docker.io", "library/nginx", "latest"), "ghcr.io/org/app:1.2@sha256:..." -> ("ghcr.io", "org/app", "sha256:...")
+    name, _, digest = image.partition('@')
+    registry, _, path = name.partition('/')
+    if not path or not ('.' in registry or ':' in registry or registry == "localhost"):
+        registry, path = "registry-1.docker.io", name
+    if registry == "docker.io":
+        registry = "registry-1.docker.io"
+
+    tag = "latest"
+    if ':' in path.rsplit('/', 1)[-1]:
+        path, tag = path.rsplit(':', 1)
+    if registry == "registry-1.docker.io" and '/' not in path:
+        path = f"library/{path}"
+
+    return registry, path, digest or tag
+
+def get_registry_digest(image: str) -> str:
+    registry, repository, reference = parse_image_reference(image)
+    if reference.startswith("sha256:"):
+        return reference
+
+    with DIGEST_CACHE_LOCK:
+        cached = DIGEST_CACHE.get(image)
+    if cached and time.time() - cached.get('checked', 0) < CONFIGS.get('DIGEST_CACHE_TTL'):
+        return cached.get('digest')
+
+    # Registries answer the first HEAD with a bearer challenge, an anonymous token for the repository is enough for public images
+    url = f"https://{registry}/v2/{repository}/manifests/{reference}"
+    headers = { "Accept": MANIFEST_TYPES }
+    manifestReq = REGISTRY_SESSION.head(url, headers=headers, timeout=30)
+    if manifestReq.status_code == 401 and manifestReq.headers.get('WWW-Authenticate', '').startswith('Bearer '):
+        challenge = dict(re.findall(r'(\w+)="([^"]*)"', manifestReq.headers.get('WWW-Authenticate')))
+        tokenReq = REGISTRY_SESSION.get(challenge.pop('realm'), params=challenge, timeout=30)
+        tokenReq.raise_for_status()
+        headers["Authorization"] = f"Bearer {tokenReq.json().get('token') or tokenReq.json().get('access_token')}"
+        manifestReq = REGISTRY_SESSION.head(url, headers=headers, timeout=30)
+
+    manifestReq.raise_for_status()
+    digest = manifestReq.headers.get('Docker-Content-Digest')
+    if not digest:
+        raise ValueError(f"registry did not return a digest for {image}")
+
+    with DIGEST_CACHE_LOCK:
+        DIGEST_CACHE[image] = { "digest": digest, "checked": time.time() }
+    return digest
+
+def get_stack_containers(stack: dict) -> list:
+    # Containers of a stack carry the compose project label, they are listed through the Portainer docker API proxy
+    filters = { "label": [f"com.docker.compose.project={stack.get('StackName')}"] }
+    containersReq = CLIENT.get(f"/endpoints/{stack.get('EndpointId')}/docker/containers/json", params={ "all": 1, "filters": json.dumps(filters) })
+    containersReq.raise_for_status()
+    return containersReq.json()
+
+def get_running_digests(stack: dict) -> dict:
+    # The repo digests of the container images tell which manifest is running
+    running = {}
+    for container in get_stack_containers(stack):
+        imageReq = CLIENT.get(f"/endpoints/{stack.get('EndpointId')}/docker/images/{container.get('ImageID')}/json")
+        imageReq.raise_for_status()
+        digests = { repoDigest.split('@', 1)[-1] for repoDigest in (imageReq.json().get('RepoDigests') or []) }
+        running.setdefault(container.get('Image'), set()).update(digests)
+    return running
+
+def stack_has_updates(stack: dict, stackFileContent: str) -> bool:
+    # Any lookup error counts as a change, the stack is then redeployed like without --skip-unchanged
+    images = IMAGE_PATTERN.findall(stackFileContent or "")
+    if not images:
+        return True
+
+    try:
+        running = get_running_digests(stack)
+        for image in images:
+            if '$' in image or image not in running:
+                return True
+            if get_registry_digest(image) not in running[image]:
+                return True
+    except (requests.RequestException, ValueError) as e:
+        pprint('WRN', f"Unable to compare image digests of stack no. {stack.get('StackId')} ({e}), redeploying")
+        return True
+
+    return False
+
 #
 ## Functions
 #
-def update_stack_containers(stacks: list, endpointId: int) -> list:
+def update_stack(stack: dict, stop: bool = True) -> dict:
+    # The four calls of a stack always run in this order, only different stacks are updated concurrently.
+    # With --skip-unchanged the compose file is fetched first, stacks that are up to date are not stopped at all.
+    # Rolling updates don't stop the stack, the redeploy replaces the containers while the old ones keep serving.
+    timings = {}
+    started = checkpoint = time.monotonic()
+    stackCompose = None
+    if CONFIGS.get('SKIP_UNCHANGED'):
+        stackCompose = CLIENT.get(f"/stacks/{stack.get('StackId')}/file", params={ "endpointId": stack.get('EndpointId') }).json()
+        hasUpdates = stack_has_updates(stack, stackCompose.get('StackFileContent'))
+        timings['check'], checkpoint = time.monotonic() - checkpoint, time.monotonic()
+        if not hasUpdates:
+            timings['total'] = time.monotonic() - started
+            return { "StackId": stack.get('StackId'), "RedeployStatus": "unchanged", "Timings": timings }
+
+    if stop:
+        stopStackReq = CLIENT.post(f"/stacks/{stack.get('StackId')}/stop", params={ "endpointId": stack.get('EndpointId') })
+        timings['stop'], checkpoint = time.monotonic() - checkpoint, time.monotonic()
+
+    if stackCompose is None:
+        getStackComposeReq = CLIENT.get(f"/stacks/{stack.get('StackId')}/file", params={ "endpointId": stack.get('EndpointId') })
+        stackCompose = getStackComposeReq.json()
+
+    getStackEnvReq = CLIENT.get(f"/stacks/{stack.get('StackId')}")
+    stackEnv = getStackEnvReq.json()
+    timings['fetch'], checkpoint = time.monotonic() - checkpoint, time.monotonic()
+    
+    data = {
+        "id": stack.get('StackId'),
+        "StackFileContent": stackCompose.get('StackFileContent'),
+        "Env": stackEnv.get('Env'),
+        "Prune": False,
+        "PullImage": True
+    }
+    redeployStackReq = CLIENT.put(f"/stacks/{stack.get('StackId')}", params={ "endpointId": stack.get('EndpointId') }, data=json.dumps(data))
+    timings['redeploy'] = time.monotonic() - checkpoint
+    timings['total'] = time.monotonic() - started
+    return { "StackId": stack.get('StackId'), "RedeployStatus": redeployStackReq.status_code, "Timings": timings }
+
+def update_stack_containers(stacks: list) -> list:
     update_logs = []
 
     for stack in stacks:
-        if stack.get('EndpointId') != endpointId:
+        try:
+            update_logs.append(update_stack(stack))
+        except requests.RequestException as e:
+            pprint('ERR', f"Stack no. {stack.get('StackId')} raised an error: {e}")
+            update_logs.append({ "StackId": stack.get('StackId'), "RedeployStatus": None })
+        
+    return update_logs
+
+def update_stacks_concurrently(stacksByEndpoint: dict, endpointIds: list) -> dict:
+    # Every endpoint has its own queue, a new stack of an endpoint is only submitted when one of its running updates finished.
+    # This keeps both limits without pool threads blocking on a busy endpoint.
+    queues = { endpointId: list(stacksByEndpoint.get(endpointId, [])) for endpointId in endpointIds }
+    update_logs = { endpointId: [] for endpointId in endpointIds }
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=CONFIGS.get('MAX_WORKERS')) as pool:
+        def submit_next(endpointId: int):
+            if queues[endpointId]:
+                stack = queues[endpointId].pop(0)
+                running[pool.submit(update_stack, stack)] = stack
+
+        for _ in range(CONFIGS.get('MAX_WORKERS_PER_ENDPOINT')):
+            for endpointId in endpointIds:
+                submit_next(endpointId)
+
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stack = running.pop(future)
+                try:
+                    update_logs[stack.get('EndpointId')].append(future.result())
+                except Exception as e:
+                    pprint('ERR', f"Stack no. {stack.get('StackId')} raised an error: {e}")
+                    update_logs[stack.get('EndpointId')].append({ "StackId": stack.get('StackId'), "RedeployStatus": None })
+                submit_next(stack.get('EndpointId'))
+
+    # Report stacks in inventory order, like the sequential update does
+    for endpointId, logs in update_logs.items():
+        order = { stack.get('StackId'): position for position, stack in enumerate(stacksByEndpoint.get(endpointId, [])) }
+        logs.sort(key=lambda status: order[status.get('StackId')])
+    return update_logs
+
+def print_update_report(statuses: list):
+    for status in statuses:
+        if status.get('RedeployStatus') == 200 and status.get('Healthy') is False:
+            pprint('ERR', f"Stack no. {status.get('StackId')} was redeployed but did not become healthy")
+        elif status.get('RedeployStatus') == 200:
+            pprint('ACT', f"Stack no. {status.get('StackId')} updated successfully")
+        elif status.get('RedeployStatus') == "unchanged":
+            pprint('INF', f"Stack no. {status.get('StackId')} is up to date, skipped")
+        elif status.get('RedeployStatus') == "halted":
+            pprint('WRN', f"Stack no. {status.get('StackId')} was not updated, rollout halted")
+        else:
+            pprint('ERR', f"Stack no. {status.get('StackId')} failed to update")
+
+def count_failures(statuses: list) -> int:
+    # Stacks that were not updated (failed redeploy, halted rollout) or did not become healthy
+    return sum(1 for status in statuses if status.get('RedeployStatus') not in (200, "unchanged") or status.get('Healthy') is False)
+
+def record_timings(endpoint: dict, stacks: list, statuses: list):
+    stackNames = { stack.get('StackId'): stack.get('StackName') for stack in stacks }
+    for status in statuses:
+        TIMINGS.record_stack(endpoint.get('EndpointName'), stackNames.get(status.get('StackId')), status)
+
+#
+## Rolling Update Functions
+#
+def wait_for_stack_health(stack: dict) -> bool:
+    # Healthy: every container runs and passed its healthcheck (if it has one), one-shot containers may have exited with code 0
+    deadline = time.monotonic() + CONFIGS.get('HEALTH_TIMEOUT')
+    while True:
+        try:
+            containers = get_stack_containers(stack)
+            if containers and all((container.get('State') == "running" and "(health: starting)" not in container.get('Status', '') and "(unhealthy)" not in container.get('Status', ''))
+                                  or (container.get('State') == "exited" and container.get('Status', '').startswith("Exited (0)")) for container in containers):
+                return True
+        except (requests.RequestException, ValueError):
+            pass
+
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(min(5, CONFIGS.get('HEALTH_TIMEOUT')))
+
+def roll_stack(stack: dict) -> dict:
+    try:
+        status = update_stack(stack, stop=False)
+    except Exception as e:
+        pprint('ERR', f"Stack no. {stack.get('StackId')} raised an error: {e}")
+        return { "StackId": stack.get('StackId'), "RedeployStatus": None }
+
+    if status.get('RedeployStatus') == 200:
+        started = time.monotonic()
+        status.update({ "Healthy": wait_for_stack_health(stack) })
+        status['Timings']['health'] = time.monotonic() - started
+    return status
+
+def roll_wave(wave: list) -> list:
+    # Like update_stacks_concurrently: a stack is only submitted while its endpoint is below MAX_WORKERS_PER_ENDPOINT
+    # and fewer than MAX_UNAVAILABLE stacks are between their redeploy and a passed health check
+    queues = {}
+    for stack in wave:
+        queues.setdefault(stack.get('EndpointId'), []).append(stack)
+    active = { endpointId: 0 for endpointId in queues }
+    running = {}
+    statuses = []
+
+    with ThreadPoolExecutor(max_workers=CONFIGS.get('MAX_UNAVAILABLE')) as pool:
+        def submit_ready():
+            for endpointId, queue in queues.items():
+                while queue and active[endpointId] < CONFIGS.get('MAX_WORKERS_PER_ENDPOINT') and len(running) < CONFIGS.get('MAX_UNAVAILABLE'):
+                    stack = queue.pop(0)
+                    active[endpointId] += 1
+                    running[pool.submit(roll_stack, stack)] = stack
+
+        submit_ready()
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stack = running.pop(future)
+                active[stack.get('EndpointId')] -= 1
+                statuses.append((stack, future.result()))
+            submit_ready()
+    return statuses
+
+def rolling_update(stacksByEndpoint: dict, endpointIds: list) -> dict:
+    # Stacks are taken from the endpoints in turn, so a wave never consists of a single endpoint only
+    queues = [list(stacksByEndpoint.get(endpointId, [])) for endpointId in endpointIds]
+    stacks = []
+    while any(queues):
+        for queue in queues:
+            if queue:
+                stacks.append(queue.pop(0))
+
+    canary = CONFIGS.get('CANARY_SIZE')
+    waves = [stacks[:canary]] + [stacks[position:position + CONFIGS.get('BATCH_SIZE')] for position in range(canary, len(stacks), CONFIGS.get('BATCH_SIZE'))]
+    update_logs = { endpointId: [] for endpointId in endpointIds }
+    failures = 0
+    halted = False
+
+    for number, wave in enumerate(waves):
+        if not wave:
+            continue
+        if halted:
+            for stack in wave:
+                update_logs[stack.get('EndpointId')].append({ "StackId": stack.get('StackId'), "RedeployStatus": "halted" })
             continue
 
-        stopStackReq = requests.post(f"{CONFIGS.get('PORTAINER_API_ENDPOINT')}/stacks/{stack.get('StackId')}/stop?endpointId={stack.get('EndpointId')}", headers=REQ_HEADERS, verify=bool(CONFIGS.get("VERIFY_TLS_CERT")))
+        pprint('INF', f"Wave {number} ({'canary' if number == 0 else 'batch'}): updating {len(wave)} stacks [Max. unavailable: {CONFIGS.get('MAX_UNAVAILABLE')}, per endpoint: {CONFIGS.get('MAX_WORKERS_PER_ENDPOINT')}]")
+        for stack, status in roll_wave(wave):
+            update_logs[stack.get('EndpointId')].append(status)
+            if status.get('RedeployStatus') not in (200, "unchanged") or status.get('Healthy') is False:
+                failures += 1
 
-        getStackComposeReq = requests.get(f"{CONFIGS.get('PORTAINER_API_ENDPOINT')}/stacks/{stack.get('StackId')}/file?endpointId={stack.get('EndpointId')}", headers=REQ_HEADERS, verify=CONFIGS.get("VERIFY_TLS_CERT"))
-        stackCompose = getStackComposeReq.json()
+        # A failing canary always stops the rollout, later waves may fail up to MAX_FAILURES stacks in total
+        if failures and (number == 0 or failures > CONFIGS.get('MAX_FAILURES')):
+            pprint('ERR', f"Halting rollout after wave {number}, {failures} stacks failed")
+            halted = True
 
-        getStackEnvReq = requests.get(f"{CONFIGS.get('PORTAINER_API_ENDPOINT')}/stacks/{stack.get('StackId')}", headers=REQ_HEADERS, verify=bool(CONFIGS.get("VERIFY_TLS_CERT")))
-        stackEnv = getStackEnvReq.json()
-        
-        data = {
-            "id": stack.get('StackId'),
-            "StackFileContent": stackCompose.get('StackFileContent'),
-            "Env": stackEnv.get('Env'),
-            "Prune": False,
-            "PullImage": True
-        }
-        redeployStackReq = requests.put(f"{CONFIGS.get('PORTAINER_API_ENDPOINT')}/stacks/{stack.get('StackId')}?endpointId={stack.get('EndpointId')}", headers=REQ_HEADERS, data=json.dumps(data), verify=bool(CONFIGS.get("VERIFY_TLS_CERT")))
-        update_logs.append({ "StackId": stack.get('StackId'), "RedeployStatus": redeployStackReq.status_code })
-        
+    for endpointId, logs in update_logs.items():
+        order = { stack.get('StackId'): position for position, stack in enumerate(stacksByEndpoint.get(endpointId, [])) }
+        logs.sort(key=lambda status: order[status.get('StackId')])
     return update_logs
 
 #
@@ -171,25 +656,49 @@ def main():
     
     pprint('INF', 'Obtaining portainer instance information')
     infrastructure = get_instance_data()
-    pprint('ACT', f'Found {len(infrastructure[0])} endpoints [No. of stacks: {len(infrastructure[1])}]')
+    pprint('ACT', f'Found {len(infrastructure[0])} endpoints [No. of stacks: {sum(len(stacks) for stacks in infrastructure[1].values())}]')
 
-    disabled_endpoints = (str(CONFIGS.get('SKIP_ENDPOINTS_LIST')).split(','))
+    if CONFIGS.get('SKIP_UNCHANGED'):
+        load_digest_cache()
 
+    disabled_endpoints = (str(CONFIGS.get('SKIP_ENDPOINTS_LIST')).split(','))
+    failures = 0
+    endpoints = []
     for endpoint in infrastructure[0]:
         if endpoint.get("EndpointName") in disabled_endpoints:
             pprint('WRN', 'Found endpoint is present in the exclusion list, skipping')
             continue
+        endpoints.append(endpoint)
 
-        pprint('INF', f'Updating stacks on endpoint {endpoint.get("EndpointName")}')
-        statuses = update_stack_containers(stacks=infrastructure[1], endpointId=endpoint.get('EndpointId'))
-        for status in statuses:
-            if status.get('RedeployStatus') == 200:
-                pprint('ACT', f"Stack no. {status.get('StackId')} updated successfully")
-            else:
-                pprint('ERR', f"Stack no. {status.get('StackId')} failed to update")
+    if CONFIGS.get('ROLLING_UPDATE') or CONFIGS.get('MAX_WORKERS') > 1:
+        if CONFIGS.get('ROLLING_UPDATE'):
+            pprint('INF', f"Rolling update of stacks on {len(endpoints)} endpoints [Canary: {CONFIGS.get('CANARY_SIZE')}, batch size: {CONFIGS.get('BATCH_SIZE')}]")
+            statuses = rolling_update(stacksByEndpoint=infrastructure[1], endpointIds=[endpoint.get('EndpointId') for endpoint in endpoints])
+        else:
+            pprint('INF', f"Updating stacks on {len(endpoints)} endpoints [Workers: {CONFIGS.get('MAX_WORKERS')}, per endpoint: {CONFIGS.get('MAX_WORKERS_PER_ENDPOINT')}]")
+            statuses = update_stacks_concurrently(stacksByEndpoint=infrastructure[1], endpointIds=[endpoint.get('EndpointId') for endpoint in endpoints])
+        for endpoint in endpoints:
+            pprint('INF', f'Stacks on endpoint {endpoint.get("EndpointName")}')
+            print_update_report(statuses[endpoint.get('EndpointId')])
+            failures += count_failures(statuses[endpoint.get('EndpointId')])
+            record_timings(endpoint, infrastructure[1].get(endpoint.get('EndpointId'), []), statuses[endpoint.get('EndpointId')])
+    else:
+        for endpoint in endpoints:
+            pprint('INF', f'Updating stacks on endpoint {endpoint.get("EndpointName")}')
+            statuses = update_stack_containers(stacks=infrastructure[1].get(endpoint.get('EndpointId'), []))
+            print_update_report(statuses)
+            failures += count_failures(statuses)
+            record_timings(endpoint, infrastructure[1].get(endpoint.get('EndpointId'), []), statuses)
     
+    if CONFIGS.get('SKIP_UNCHANGED'):
+        save_digest_cache()
+    TIMINGS.close()
+
+    if failures:
+        pprint('ERR', f'{failures} stacks were not updated successfully')
     print(F'\n{F.LIGHTMAGENTA_EX}Part of sysadmin-scripts Github Repository [https://github.com/unkn0wnAPI/sysadmin-scripts]{S.RESET_ALL}\n')
+    return 1 if failures else 0
 
 
 if __name__ == "__main__":
-    main()
+    exit(main())
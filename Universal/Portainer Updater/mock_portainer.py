@@ -0,0 +1,202 @@
+#!/usr/bin/python3
+
+#
+## Script Name: Mock Portainer API
+## Author:      unkn0wnAPI [https://github.com/unkn0wnAPI]
+## Information: Local stand-in for the Portainer API used to test and benchmark the Portainer Updater
+#
+
+#
+## Imports
+#
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import threading, argparse, random, json, time, re
+
+#
+## Init configuration variable
+#
+STACK_FILE = "services:\n  app:\n    image: nginx:latest\n"
+ROUTES = [
+    ("GET", re.compile(r"^/motd$"), "motd"),
+    ("GET", re.compile(r"^/endpoints$"), "endpoints"),
+    ("GET", re.compile(r"^/stacks$"), "stacks"),
+    ("GET", re.compile(r"^/stacks/(\d+)$"), "stack"),
+    ("GET", re.compile(r"^/stacks/(\d+)/file$"), "stack_file"),
+    ("POST", re.compile(r"^/stacks/(\d+)/stop$"), "stack_stop"),
+    ("PUT", re.compile(r"^/stacks/(\d+)$"), "stack_redeploy"),
+    ("GET", re.compile(r"^/endpoints/(\d+)/docker/containers/json$"), "containers"),
+    ("GET", re.compile(r"^/endpoints/(\d+)/docker/images/([^/]+)/json$"), "image"),
+    ("GET", re.compile(r"^/mock/stats$"), "stats"),
+    ("POST", re.compile(r"^/mock/reset$"), "reset"),
+]
+
+#
+## Core Functions
+#
+class MockState:
+    # Inventory and request statistics shared by all handler threads
+    def __init__(self, endpoints: int, stacks: int, api_key: str, latency: float, redeploy_latency: float, failure_rate: float, seed: int):
+        self.api_key = api_key
+        self.latency = latency
+        self.redeploy_latency = redeploy_latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.endpoints = [{ "Id": endpointId, "Name": f"endpoint-{endpointId}" } for endpointId in range(1, endpoints + 1)]
+        self.stacks = { endpointId * 10000 + number: { "Id": endpointId * 10000 + number, "Name": f"stack-{endpointId}-{number}", "EndpointId": endpointId, "Env": [] }
+                        for endpointId in range(1, endpoints + 1) for number in range(1, stacks + 1) }
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = {}
+            self.failures = 0
+            self.redeploying = 0
+            self.peak_redeploying = 0
+            self.started = time.time()
+
+    def count(self, route: str, status: int):
+        with self.lock:
+            self.requests[f"{route} {status}"] = self.requests.get(f"{route} {status}", 0) + 1
+
+    def fail(self) -> bool:
+        with self.lock:
+            return self.random.random() < self.failure_rate
+
+    def stats(self) -> dict:
+        with self.lock:
+            return { "requests": dict(sorted(self.requests.items())), "total_requests": sum(self.requests.values()), "failures_injected": self.failures,
+                     "peak_concurrent_redeploys": self.peak_redeploying, "seconds": round(time.time() - self.started, 3) }
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "MockPortainer"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, route: str, status: int, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        if route not in ("stats", "reset"):
+            self.server.state.count(route, status)
+
+    def handle_request(self, method: str):
+        state = self.server.state
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+        route, match = next(((name, pattern.match(url.path)) for routeMethod, pattern, name in ROUTES if routeMethod == method and pattern.match(url.path)), (None, None))
+        if route is None:
+            return self.send_json("unknown", 404, { "message": "Not found" })
+        if route == "stats":
+            return self.send_json(route, 200, state.stats())
+        if route == "reset":
+            state.reset()
+            return self.send_json(route, 200, {})
+        if self.headers.get("X-API-Key") != state.api_key:
+            return self.send_json(route, 401, { "message": "Unauthorized" })
+
+        time.sleep(state.latency)
+        if route == "motd":
+            return self.send_json(route, 200, { "Title": "", "Message": "Mock Portainer" })
+        if route == "endpoints":
+            return self.send_json(route, 200, state.endpoints)
+        if route == "stacks":
+            filters = json.loads(query.get("filters", ["{}"])[0])
+            stacks = [stack for stack in state.stacks.values() if filters.get("EndpointId") in (None, stack.get("EndpointId"))]
+            return self.send_json(route, 200, stacks)
+        if route in ("containers", "image"):
+            return self.handle_docker(route, match, query)
+
+        stack = state.stacks.get(int(match.group(1)))
+        if stack is None:
+            return self.send_json(route, 404, { "message": "Stack not found" })
+        if route == "stack":
+            return self.send_json(route, 200, stack)
+        if route == "stack_file":
+            return self.send_json(route, 200, { "StackFileContent": STACK_FILE })
+        if route == "stack_stop":
+            return self.send_json(route, 200, stack)
+
+        # Redeploys take the configured time (image pulls) and fail at the configured rate
+        with state.lock:
+            state.redeploying += 1
+            state.peak_redeploying = max(state.peak_redeploying, state.redeploying)
+        try:
+            time.sleep(state.redeploy_latency)
+            if state.fail():
+                with state.lock:
+                    state.failures += 1
+                return self.send_json(route, 500, { "message": "Injected failure" })
+            json.loads(body or b"{}")
+            return self.send_json(route, 200, stack)
+        finally:
+            with state.lock:
+                state.redeploying -= 1
+
+    def handle_docker(self, route: str, match, query: dict):
+        if route == "image":
+            return self.send_json(route, 200, { "Id": match.group(2), "RepoDigests": ["nginx@sha256:mock"] })
+
+        labels = json.loads(query.get("filters", ["{}"])[0]).get("label", [])
+        project = labels[0].split("=", 1)[-1] if labels else None
+        containers = [{ "Id": f"container-{stack.get('Id')}", "Image": "nginx:latest", "ImageID": "sha256:mock", "State": "running", "Status": "Up 5 seconds",
+                        "Labels": { "com.docker.compose.project": stack.get("Name") } }
+                      for stack in self.server.state.stacks.values() if stack.get("EndpointId") == int(match.group(1)) and project in (None, stack.get("Name"))]
+        return self.send_json(route, 200, containers)
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PUT(self):
+        self.handle_request("PUT")
+
+def create_server(host: str = "127.0.0.1", port: int = 9000, endpoints: int = 3, stacks: int = 10, api_key: str = "mock",
+                  latency: float = 0.01, redeploy_latency: float = 1.0, failure_rate: float = 0.0, seed: int = 1337) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), MockHandler)
+    server.daemon_threads = True
+    server.state = MockState(endpoints, stacks, api_key, latency, redeploy_latency, failure_rate, seed)
+    return server
+
+def init_arg_parse():
+    args = argparse.ArgumentParser(description='Local stand-in for the Portainer API used to test and benchmark the Portainer Updater', epilog="Written by unkn0wnAPI, part of sysadmin-scripts [https://github.com/unkn0wnapi/sysadmin-scripts]")
+    args.add_argument('--host', action='store', dest='host', default='127.0.0.1', help='Address the mock API listens on [defaults to 127.0.0.1]')
+    args.add_argument('--port', '-p', action='store', type=int, dest='port', default=9000, help='Port the mock API listens on [defaults to 9000]')
+    args.add_argument('--endpoints', '-e', action='store', type=int, dest='endpoints', default=3, help='Number of endpoints [defaults to 3]')
+    args.add_argument('--stacks', '-s', action='store', type=int, dest='stacks', default=10, help='Number of stacks per endpoint [defaults to 10]')
+    args.add_argument('--api-key', '-k', action='store', dest='key', default='mock', help='API key accepted by the mock API [defaults to mock]')
+    args.add_argument('--latency', '-l', action='store', type=float, dest='latency', default=10, help='Latency of every API request in ms [defaults to 10]')
+    args.add_argument('--redeploy-latency', '-rl', action='store', type=float, dest='redeploy_latency', default=1000, help='Additional latency of a stack redeploy in ms [defaults to 1000]')
+    args.add_argument('--failure-rate', '-f', action='store', type=float, dest='failure_rate', default=0.0, help='Share of redeploys that fail with HTTP 500 (0.0 - 1.0) [defaults to 0.0]')
+    args.add_argument('--seed', action='store', type=int, dest='seed', default=1337, help='Seed of the failure injection [defaults to 1337]')
+
+    return args.parse_args()
+
+#
+## Script Start point
+#
+def main():
+    ARGS = init_arg_parse()
+    server = create_server(ARGS.host, ARGS.port, ARGS.endpoints, ARGS.stacks, ARGS.key, ARGS.latency / 1000, ARGS.redeploy_latency / 1000, ARGS.failure_rate, ARGS.seed)
+    print(f"[INF] Mock Portainer API listening on http://{ARGS.host}:{ARGS.port} [{ARGS.endpoints} endpoints, {ARGS.endpoints * ARGS.stacks} stacks, API key: {ARGS.key}]")
+    print(f"[INF] Request statistics: GET http://{ARGS.host}:{ARGS.port}/mock/stats, reset: POST http://{ARGS.host}:{ARGS.port}/mock/reset")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()